@@ -0,0 +1,14 @@
+#!/usr/bin/python3
+
+import configparser
+
+from megatick.retention import RetentionJob
+
+def main():
+    """Move old page content and text out of the graph into the archive."""
+    conf = configparser.ConfigParser()
+    conf.read("config.ini")
+    RetentionJob(conf).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+import configparser
+import time
+
+import tweepy
+
+from megatick.backfill import Backfill
+from megatick.listeners import MegatickStreamListener
+from megatick.utils import create_graph, create_twitter_auth, read_lines
+
+def main():
+    """Record recent tweets for keywords and users not yet backfilled."""
+    conf = configparser.ConfigParser()
+    conf.read("config.ini")
+    graph = None
+    if conf.getboolean("neo4j", "useNeo4j"):
+        graph = create_graph(conf)
+    api = tweepy.API(create_twitter_auth(conf),
+                     wait_on_rate_limit=True,
+                     wait_on_rate_limit_notify=True)
+    listener = MegatickStreamListener(api=api, graph=graph, conf=conf)
+    backfill = Backfill(conf, listener)
+    backfill.add(read_lines(conf.get("twitter", "keywordsLoc")),
+                 read_lines(conf.get("twitter", "usersLoc")))
+    backfill.join()
+
+    # let the backfilled tweets be recorded, and their threads and links
+    # followed, before stopping. Each stage only hands work on to later
+    # ones, so they are waited for in order.
+    listener.status_queue.join()
+    if graph is not None:
+        listener.thread_queue.join()
+        listener.scraper.queue.join()
+        while listener.scraper.scheduler.pending() > 0:
+            time.sleep(1)
+        listener.writer.join()
+        if listener.search_index is not None:
+            listener.search_index.flush()
+    # the worker threads are daemons, so this exits once they are idle (and
+    # the CSV writer flushes on exit)
+
+if __name__ == "__main__":
+    main()
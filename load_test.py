@@ -0,0 +1,11 @@
+#!/usr/bin/python3
+
+from megatick.loadtest import LoadTest
+
+def main():
+    """Measure the tweet rate the configuration in config.ini sustains."""
+    load_test = LoadTest()
+    load_test.run()
+
+if __name__ == "__main__":
+    main()
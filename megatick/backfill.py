@@ -0,0 +1,241 @@
+"""
+Backfill of recent history for keywords (from the search API) and users
+(from their timelines), so that newly added ones aren't only followed from
+then on. Several pagers work through the keywords and users at once, sharing
+each endpoint's rate limit, and checkpoint their place so that an
+interrupted backfill carries on where it stopped. Tweets found are passed to
+the listener's queue, so they are filtered, recorded and followed like
+streamed tweets.
+"""
+
+import calendar
+import json
+import os
+import time
+from queue import Queue
+from threading import Condition, Lock, Thread
+
+import tweepy
+
+from megatick.records import StatusRecord
+from megatick.utils import create_twitter_auth
+
+# standard (user auth) requests per 15 minute window
+SEARCH_LIMIT = 180
+TIMELINE_LIMIT = 900
+WINDOW = 15 * 60
+
+class RateBudget:
+    """
+    Requests shared between pagers: up to limit per window, refilled
+    steadily, with every pager held back when Twitter says the limit is hit
+    """
+    def __init__(self, limit, window=WINDOW):
+        self.limit = limit
+        self.rate = limit / window
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.condition = Condition()
+
+    def acquire(self):
+        """Wait for, and use up, one request"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.limit,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now,
+                           (1 - self.tokens) / self.rate)
+                self.condition.wait(wait)
+
+    def pause(self, seconds):
+        """Hold every pager back for a time (after a rate limit error)"""
+        with self.condition:
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+class Checkpoint:
+    """
+    Pagination state of each backfill job, by key, saved (atomically) to a
+    JSON file after every page
+    """
+    def __init__(self, location):
+        self.location = location
+        self.lock = Lock()
+        self.jobs = {}
+        if os.path.exists(location):
+            with open(location, "r") as in_file:
+                self.jobs = json.load(in_file)
+
+    def get(self, key):
+        """The state of a job: max_id to page from, count, and done"""
+        with self.lock:
+            return dict(self.jobs.get(key,
+                                      {"max_id": None,
+                                       "count": 0,
+                                       "done": False}))
+
+    def update(self, key, state):
+        """Save the new state of a job"""
+        with self.lock:
+            self.jobs[key] = state
+            temp_loc = self.location + ".tmp"
+            with open(temp_loc, "w") as out_file:
+                json.dump(self.jobs, out_file)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            os.replace(temp_loc, self.location)
+
+def rate_limit_reset(error):
+    """Seconds until the limit behind a RateLimitError resets"""
+    response = getattr(error, "response", None)
+    if response is not None and "x-rate-limit-reset" in response.headers:
+        reset = int(response.headers["x-rate-limit-reset"])
+        return max(1.0, reset - time.time())
+    return WINDOW
+
+class Backfill:
+    """
+    Pages back through the search results for keywords and the timelines of
+    users, up to twitter.backfillDays (default 7) old, with
+    twitter.backfillPagers (default 4) pagers, passing the tweets found to
+    listener
+    """
+    def __init__(self, conf, listener, api=None):
+        self.conf = conf
+        self.listener = listener
+
+        # rate limits are handled here (and shared), not by tweepy
+        if api is None:
+            api = tweepy.API(create_twitter_auth(conf))
+        self.api = api
+
+        self.max_age = 7 * 24 * 60 * 60
+        if conf.has_option("twitter", "backfillDays"):
+            self.max_age = (conf.getfloat("twitter", "backfillDays") *
+                            24 * 60 * 60)
+        search_limit = SEARCH_LIMIT
+        if conf.has_option("twitter", "searchRateLimit"):
+            search_limit = conf.getint("twitter", "searchRateLimit")
+        timeline_limit = TIMELINE_LIMIT
+        if conf.has_option("twitter", "timelineRateLimit"):
+            timeline_limit = conf.getint("twitter", "timelineRateLimit")
+        self.budgets = {"search": RateBudget(search_limit),
+                        "timeline": RateBudget(timeline_limit)}
+
+        checkpoint_loc = "backfill.json"
+        if conf.has_option("twitter", "backfillCheckpointLoc"):
+            checkpoint_loc = conf.get("twitter", "backfillCheckpointLoc")
+        self.checkpoint = Checkpoint(checkpoint_loc)
+
+        # keys of jobs waiting or in progress, so none is queued twice
+        self.queued = set()
+        self.lock = Lock()
+        self.jobs = Queue(maxsize=0)
+        num_pagers = 4
+        if conf.has_option("twitter", "backfillPagers"):
+            num_pagers = conf.getint("twitter", "backfillPagers")
+        for _ in range(num_pagers):
+            thread = Thread(target=self.page, daemon=True)
+            thread.start()
+
+    def add(self, keywords=(), users=()):
+        """
+        Queue the keywords and users (IDs) not yet backfilled, returning how
+        many were queued
+        """
+        count = 0
+        for key in (["search:" + keyword for keyword in keywords] +
+                    ["timeline:" + user for user in users]):
+            with self.lock:
+                if key in self.queued or self.checkpoint.get(key)["done"]:
+                    continue
+                self.queued.add(key)
+            self.jobs.put(key)
+            count += 1
+        if count > 0:
+            print("Backfilling %d keywords and users" % count)
+        return count
+
+    def join(self):
+        """Wait until every queued job is finished"""
+        self.jobs.join()
+
+    def page(self):
+        """Pager thread: work through queued jobs"""
+        while True:
+            key = self.jobs.get()
+            try:
+                self.run_job(key)
+            except Exception as error:
+                # left unfinished in the checkpoint, so retried next time
+                print("Error backfill %s: %s" % (key, str(error)))
+            with self.lock:
+                self.queued.discard(key)
+            self.jobs.task_done()
+
+    def fetch(self, key, max_id):
+        """One page of tweets (tweepy Statuses), newest first"""
+        endpoint, query = key.split(":", 1)
+        while True:
+            self.budgets[endpoint].acquire()
+            try:
+                if endpoint == "search":
+                    return self.api.search(q=query + " -filter:retweets",
+                                           count=100,
+                                           max_id=max_id,
+                                           result_type="recent",
+                                           tweet_mode="extended")
+                return self.api.user_timeline(user_id=query,
+                                              count=200,
+                                              max_id=max_id,
+                                              include_rts=False,
+                                              tweet_mode="extended")
+            except tweepy.RateLimitError as error:
+                # another client may share our limit, so hold every pager
+                # back until it resets, then try this page again
+                self.budgets[endpoint].pause(rate_limit_reset(error))
+
+    def run_job(self, key):
+        """Page back through one keyword or user, from its checkpoint"""
+        state = self.checkpoint.get(key)
+        cutoff = time.time() - self.max_age
+        while not state["done"]:
+            statuses = self.fetch(key, state["max_id"])
+            old = False
+            for status in statuses:
+                # created_at is a naive UTC datetime
+                if calendar.timegm(status.created_at.timetuple()) < cutoff:
+                    old = True
+                    continue
+                if self.record(status._json):
+                    state["count"] += 1
+            if statuses:
+                state["max_id"] = min(status.id for status in statuses) - 1
+            state["done"] = old or not statuses
+            self.checkpoint.update(key, state)
+        print("Backfilled %s: %d tweets" % (key, state["count"]))
+
+    def record(self, data):
+        """
+        Pass a tweet's JSON to the listener (as its on_data would), unless it
+        was already seen on the stream, has been deleted, or is already in
+        the graph
+        """
+        listener = self.listener
+        if not listener.seen_tweets.add(data["id"]):
+            return False
+        if data["id"] in listener.tombstones:
+            return False
+        if listener.graph is not None and listener.is_known(data["id"]):
+            return False
+        if not listener.prefilter.passes_raw(data):
+            return False
+        listener.on_status(StatusRecord.from_json(data))
+        return True
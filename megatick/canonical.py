@@ -0,0 +1,152 @@
+"""
+Reduce the many URLs an article can be cited by (shortened links, tracking
+parameters, trailing slashes) to a single canonical URL, remembering the
+mapping in a persistent local cache.
+"""
+
+import re
+import sqlite3
+import time
+from threading import Lock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+# hosts whose only job is to redirect somewhere else
+SHORTENERS = {"bit.ly",
+              "buff.ly",
+              "dlvr.it",
+              "fb.me",
+              "feedproxy.google.com",
+              "goo.gl",
+              "ift.tt",
+              "lnkd.in",
+              "ow.ly",
+              "t.co",
+              "tinyurl.com",
+              "trib.al",
+              "wp.me"}
+
+# query parameters that identify the referrer rather than the content
+TRACKING_PARAMS = re.compile(r"^(utm_\w*|fbclid|gclid|dclid|msclkid|igshid|"
+                             r"mc_cid|mc_eid|_ga|_hsenc|_hsmi|yclid|"
+                             r"ref_src|ref_url|cmpid|ncid|smid|"
+                             r"__twitter_impression)$",
+                             re.IGNORECASE)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url):
+    """
+    Normalize a URL by rule, without any network I/O: lowercase scheme and
+    host, drop default ports, fragments, tracking parameters and trailing
+    slashes, and sort the remaining query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is None or DEFAULT_PORTS.get(scheme) == port:
+        netloc = host
+    else:
+        netloc = "%s:%d" % (host, port)
+    path = re.sub("/{2,}", "/", parts.path).rstrip("/")
+    params = [(key, value)
+              for key, value in parse_qsl(parts.query, keep_blank_values=True)
+              if TRACKING_PARAMS.match(key) is None]
+    query = urlencode(sorted(params))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+class UrlCache:
+    """Persistent (SQLite) mapping of URLs to their canonical form"""
+    def __init__(self, location):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS url_map "
+                                    "(url TEXT PRIMARY KEY, "
+                                    "canonical TEXT NOT NULL, "
+                                    "resolved_at REAL)")
+
+    def get(self, url):
+        """Return the canonical form of url, or None if it is not cached"""
+        with self.lock:
+            row = self.connection.execute("SELECT canonical FROM url_map "
+                                          "WHERE url = ?", (url,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, urls, canonical):
+        """Record that each of urls has the given canonical form"""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO url_map "
+                                        "VALUES (?, ?, ?)",
+                                        [(url, canonical, now)
+                                         for url in urls])
+
+class Canonicalizer:
+    """
+    Resolve shortened URLs and normalize the result, consulting (and filling)
+    a persistent cache so each link is resolved over the network only once.
+    """
+    def __init__(self, conf):
+        cache_loc = "url_cache.sqlite"
+        if conf.has_option("DEFAULT", "urlCacheLoc"):
+            cache_loc = conf.get("DEFAULT", "urlCacheLoc")
+        self.cache = UrlCache(cache_loc)
+
+        # extra redirecting hosts, one per line
+        self.shorteners = set(SHORTENERS)
+        if conf.has_option("DEFAULT", "shortenersLoc"):
+            with open(conf.get("DEFAULT", "shortenersLoc"), "r") as sh_file:
+                self.shorteners.update(line.strip().lower()
+                                       for line in sh_file)
+
+        self.timeout = 10.0
+        if conf.has_option("DEFAULT", "urlTimeout"):
+            self.timeout = conf.getfloat("DEFAULT", "urlTimeout")
+
+    def resolve(self, url):
+        """Follow redirects from url and return the final URL (or None)"""
+        try:
+            response = requests.head(url,
+                                     allow_redirects=True,
+                                     timeout=self.timeout)
+            # some shorteners refuse HEAD, so fall back to a streamed GET
+            if response.status_code >= 400:
+                response = requests.get(url,
+                                        allow_redirects=True,
+                                        stream=True,
+                                        timeout=self.timeout)
+                response.close()
+            return response.url
+        except requests.exceptions.RequestException as err:
+            print("Error resolving %s: %s" % (url, err))
+            return None
+
+    def canonicalize(self, url):
+        """Return the canonical form of url"""
+        cached = self.cache.get(url)
+        if cached is not None:
+            return cached
+
+        normalized = normalize_url(url)
+        cached = self.cache.get(normalized)
+        if cached is not None:
+            self.cache.put([url], cached)
+            return cached
+
+        if urlsplit(normalized).hostname not in self.shorteners:
+            self.cache.put({url, normalized}, normalized)
+            return normalized
+
+        resolved = self.resolve(url)
+        if resolved is None:
+            # don't remember failures, so that the link is retried later
+            return normalized
+        canonical = normalize_url(resolved)
+        self.cache.put({url, normalized, canonical}, canonical)
+        return canonical
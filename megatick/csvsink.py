@@ -0,0 +1,229 @@
+"""
+Rotating, compressed CSV output. Rows are buffered and written in blocks,
+each block one compressed member (gzip) or frame (zstd) appended to the
+current segment file, so that a segment is always a valid compressed file
+up to its last complete block. Segments are rotated by size and age, and
+completed ones are listed in a manifest. A state file records how much of
+the current segment is complete, so that after a restart it is trimmed back
+to that point and appended to rather than started afresh.
+"""
+
+import atexit
+import csv
+import gzip
+import io
+import json
+import os
+import time
+from threading import Lock, Thread
+
+def get_compressor(compression):
+    """Return (compress function, file extension) for a compression name"""
+    if compression == "gzip":
+        return gzip.compress, ".csv.gz"
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress, ".csv.zst"
+    if compression == "none":
+        return (lambda data: data), ".csv"
+    raise ValueError("Unknown CSV compression: " + compression)
+
+def get_decompressor(name):
+    """Return a function reading a whole segment file, by its name"""
+    if name.endswith(".gz"):
+        return gzip.decompress
+    if name.endswith(".zst"):
+        import zstandard
+        def decompress(data):
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                io.BytesIO(data), read_across_frames=True)
+            return reader.read()
+        return decompress
+    return lambda data: data
+
+class RotatingCsvWriter:
+    """
+    Writes rows to compressed CSV segments in directory, each starting with
+    header, rotated after max_bytes (compressed) or max_age seconds.
+    Buffered rows are written every flush_rows rows or flush_interval
+    seconds, whichever comes first.
+    """
+    def __init__(self, directory, header, prefix=None, compression="gzip",
+                 max_bytes=100 * 1024 * 1024, max_age=24 * 60 * 60,
+                 flush_rows=1000, flush_interval=10.0):
+        self.directory = directory
+        self.header = header
+        self.prefix = "" if prefix is None else prefix + "_"
+        self.compress, self.extension = get_compressor(compression)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.manifest_loc = os.path.join(directory,
+                                         self.prefix + "manifest.jsonl")
+        self.state_loc = os.path.join(directory, self.prefix + "current.json")
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = Lock()
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.buffered = 0
+
+        # the current segment: file name, complete bytes, rows, start time
+        self.segment = None
+        self.size = 0
+        self.rows = 0
+        self.started = None
+        self.resume()
+
+        thread = Thread(target=self.flush_periodically, daemon=True)
+        thread.start()
+        # don't lose buffered rows on a normal exit
+        atexit.register(self.flush)
+
+    def resume(self):
+        """
+        Continue the segment recorded in the state file, if any, trimming off
+        anything written after its last complete block
+        """
+        if not os.path.exists(self.state_loc):
+            return
+        with open(self.state_loc, "r") as state_file:
+            state = json.load(state_file)
+        location = os.path.join(self.directory, state["segment"])
+        if not os.path.exists(location):
+            return
+        with open(location, "r+b") as segment_file:
+            segment_file.truncate(state["size"])
+        self.segment = state["segment"]
+        self.size = state["size"]
+        self.rows = state["rows"]
+        self.started = state["started"]
+        print("Resuming CSV segment " + location)
+
+    def save_state(self):
+        """Record the current segment's progress (atomically)"""
+        temp_loc = self.state_loc + ".tmp"
+        with open(temp_loc, "w") as state_file:
+            json.dump({"segment": self.segment,
+                       "size": self.size,
+                       "rows": self.rows,
+                       "started": self.started}, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_loc, self.state_loc)
+
+    def writerow(self, row):
+        """Buffer a row, writing out the buffer if it is full"""
+        with self.lock:
+            self.writer.writerow(row)
+            self.buffered += 1
+            if self.buffered >= self.flush_rows:
+                self.write_block()
+
+    def flush(self):
+        """Write out any buffered rows"""
+        with self.lock:
+            self.write_block()
+
+    def flush_periodically(self):
+        """Flush every flush_interval seconds, so quiet streams are written"""
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def write_block(self):
+        """Append buffered rows to the current segment as one block"""
+        if self.buffered == 0:
+            return
+        if (self.segment is not None and
+                (self.size >= self.max_bytes or
+                 time.time() - self.started >= self.max_age)):
+            self.rotate()
+        data = self.buffer.getvalue()
+        if self.segment is None:
+            self.start_segment()
+            header = io.StringIO()
+            csv.writer(header).writerow(self.header)
+            data = header.getvalue() + data
+        block = self.compress(data.encode("utf-8"))
+        location = os.path.join(self.directory, self.segment)
+        with open(location, "ab") as segment_file:
+            segment_file.write(block)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        self.size += len(block)
+        self.rows += self.buffered
+        self.save_state()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffered = 0
+
+    def start_segment(self):
+        """Begin a new segment, named by its start time"""
+        self.started = time.time()
+        name = self.prefix + time.strftime("%Y-%m-%dT%H-%M-%S",
+                                           time.localtime(self.started))
+        # never append to an earlier segment started in the same second
+        self.segment = name + self.extension
+        count = 1
+        while os.path.exists(os.path.join(self.directory, self.segment)):
+            self.segment = "%s_%d%s" % (name, count, self.extension)
+            count += 1
+        self.size = 0
+        self.rows = 0
+
+    def rotate(self):
+        """Close the current segment and list it in the manifest"""
+        with open(self.manifest_loc, "a") as manifest_file:
+            manifest_file.write(json.dumps({"segment": self.segment,
+                                            "rows": self.rows,
+                                            "bytes": self.size,
+                                            "started": self.started,
+                                            "finished": time.time()}) + "\n")
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        self.segment = None
+        os.remove(self.state_loc)
+
+def read_csv_segments(directory, prefix=None, tombstones=None):
+    """
+    Yield the rows of every segment in directory, completed ones (in the
+    order of the manifest) then the current one, after a single header row.
+    Rows whose id is in tombstones (e.g. a TombstoneIndex) are left out.
+    """
+    prefix = "" if prefix is None else prefix + "_"
+    segments = []
+    manifest_loc = os.path.join(directory, prefix + "manifest.jsonl")
+    if os.path.exists(manifest_loc):
+        with open(manifest_loc, "r") as manifest_file:
+            segments = [json.loads(line)["segment"] for line in manifest_file]
+    state_loc = os.path.join(directory, prefix + "current.json")
+    if os.path.exists(state_loc):
+        with open(state_loc, "r") as state_file:
+            state = json.load(state_file)
+        segments.append(state["segment"])
+
+    header_seen = False
+    for segment in segments:
+        with open(os.path.join(directory, segment), "rb") as segment_file:
+            data = segment_file.read()
+        if segment == segments[-1] and os.path.exists(state_loc):
+            # only the complete part of the current segment
+            data = data[:state["size"]]
+        text = get_decompressor(segment)(data).decode("utf-8")
+        rows = csv.reader(io.StringIO(text))
+        header = next(rows, None)
+        if header is None:
+            continue
+        if not header_seen:
+            header_seen = True
+            yield header
+        if tombstones is None:
+            yield from rows
+        else:
+            id_column = header.index("id")
+            for row in rows:
+                if row[id_column] not in tombstones:
+                    yield row
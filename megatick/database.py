@@ -2,17 +2,116 @@
 Utility functions relating to the Neo4j database.
 """
 
+import re
+import time
+
+from megatick.embedded import EmbeddedGraph
+from megatick.tracing import TRACER
 from megatick.utils import get_full_text
 from megatick.nodes import *
 from megatick.relations import *
 
-def tweet_to_neo4j(graph, status, full_text=None):
+# counters kept up to date on nodes, which top_nodes queries are indexed on
+COUNTERS = [("WebPage", "cited_count"),
+            ("Tweet", "cited_count"),
+            ("TwitterUser", "authored_count"),
+            ("Redditor", "authored_count")]
+
+def snake_case(label):
+    """A node label as used in property names, e.g. reddit_submission"""
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", label).lower()
+
+def merge_counted(graph, relationship, counted="end", counter="cited"):
+    """
+    Merge a relationship between two nodes already in the graph and, only if
+    it did not exist yet, count it on its end (or start) node: counter_count
+    is incremented, first_counter and last_counter hold the times of the
+    first and latest, and counter_by_label counts them by the label of the
+    node at the other end (e.g. cited_by_tweet). Merging the same
+    relationship again counts nothing. Returns True if it was created.
+    """
+    if counted == "end":
+        node, other = relationship.end_node, relationship.start_node
+    else:
+        node, other = relationship.start_node, relationship.end_node
+    names = {"count": counter + "_count",
+             "first": "first_" + counter,
+             "last": "last_" + counter,
+             "by": "%s_by_%s" % (counter, snake_case(min(other.labels)))}
+    now = time.time()
+
+    if isinstance(graph, EmbeddedGraph):
+        created, properties = graph.merge_counted(relationship, node,
+                                                  names, now)
+    else:
+        cypher = ("MATCH (a) WHERE id(a) = $start "
+                  "MATCH (b) WHERE id(b) = $end "
+                  "MERGE (a)-[r:%(type)s]->(b) "
+                  "ON CREATE SET r += $properties, r.uncounted = true, "
+                  "%(n)s.%(count)s = coalesce(%(n)s.%(count)s, 0) + 1, "
+                  "%(n)s.%(by)s = coalesce(%(n)s.%(by)s, 0) + 1, "
+                  "%(n)s.%(first)s = coalesce(%(n)s.%(first)s, $now), "
+                  "%(n)s.%(last)s = $now "
+                  "WITH r, %(n)s, r.uncounted IS NOT NULL AS created "
+                  "REMOVE r.uncounted "
+                  "RETURN created, properties(%(n)s)" %
+                  dict(names,
+                       type=type(relationship).__name__,
+                       n="b" if counted == "end" else "a"))
+        created, properties = graph.run(cypher,
+                                        start=relationship.start_node.identity,
+                                        end=relationship.end_node.identity,
+                                        properties=dict(relationship),
+                                        now=now).next()
+    # keep the local node up to date, so that pushing it keeps the counts
+    for name in names.values():
+        if name in properties:
+            node[name] = properties[name]
+    return created
+
+def top_nodes(graph, label, counter, limit=10):
+    """
+    Return up to limit nodes with this label, highest counter first (e.g.
+    "WebPage" and "cited_count" for the most cited pages)
+    """
+    if isinstance(graph, EmbeddedGraph):
+        return graph.top(label, counter, limit)
+    return [record[0] for record in
+            graph.run("MATCH (n:%s) WHERE n.%s IS NOT NULL "
+                      "RETURN n ORDER BY n.%s DESC LIMIT $limit" %
+                      (label, counter, counter),
+                      limit=limit)]
+
+def ensure_indexes(graph):
+    """Create the indexes top_nodes uses for each of COUNTERS, if missing"""
+    for label, counter in COUNTERS:
+        if isinstance(graph, EmbeddedGraph):
+            graph.create_index(counter)
+        else:
+            graph.run("CREATE INDEX %s_%s IF NOT EXISTS FOR (n:%s) ON (n.%s)" %
+                      (snake_case(label), counter, label, counter))
+
+@TRACER.trace("tweet_to_neo4j")
+def tweet_to_neo4j(graph, status, full_text=None, notability=None,
+                   duplicate_of=None, search_index=None):
     """
-    Given a JSON rep of a status, add it to the Neo4j database (or update)
+    Given a JSON rep of a status, add it to the Neo4j database (or update),
+    along with its notability score if it has one. A near-duplicate of an
+    existing tweet (by ID) is stored without its text and linked to it.
+    If a search index is given, the text is indexed there too.
     """
     if full_text is None:
         full_text = get_full_text(status)
 
+    original = None
+    if duplicate_of is not None:
+        original = get_tweet_node_by_id(graph, duplicate_of)
+        # a deleted (tombstoned) tweet has no text left to share
+        if original is not None and original.get("deleted") is None:
+            full_text = None
+        else:
+            original = None
+
     tweet = Tweet(status.id,
                   full_text,
                   status.created_at,
@@ -23,8 +122,15 @@ def tweet_to_neo4j(graph, status, full_text=None):
                   status.retweeted,
                   status.source,
                   status.favorited,
-                  status.retweet_count)
+                  status.retweet_count,
+                  notability)
+    if original is not None:
+        tweet["duplicate_of"] = duplicate_of
     tweet.add_to(graph)
+    if original is not None:
+        graph.merge(DUPLICATE_OF(tweet, original))
+    if search_index is not None and full_text is not None:
+        search_index.add("Tweet", status.id, None, full_text)
     # print("added tweet")
     user = TwitterUser(status.user.id,
                        status.user.screen_name,
@@ -49,7 +155,7 @@ def tweet_to_neo4j(graph, status, full_text=None):
     user.add_to(graph)
 
     authored = AUTHORED(user, tweet)
-    graph.merge(authored)
+    merge_counted(graph, authored, counted="start", counter="authored")
 
     return (user, tweet, authored)
 
@@ -58,26 +164,155 @@ def get_tweet_node(graph, status):
     Search for a Tweet node in the graph matching this status, and return it
     if it exists (otherwise None).
     """
-    return graph.nodes.match("Tweet", tweet_id=status.id).first()
+    return get_tweet_node_by_id(graph, status.id)
+
+def get_tweet_node_by_id(graph, tweet_id):
+    """
+    Search for a Tweet node in the graph with this ID, and return it if it
+    exists (otherwise None).
+    """
+    return graph.nodes.match("Tweet", tweet_id=tweet_id).first()
+
+# relationships to or from a tweet that are counted on the node at the
+# other end, by type: the counted end and counter (as in merge_counted)
+TWEET_COUNTED = {"AUTHORED": ("start", "authored"),
+                 "LINKS_TO": ("end", "cited")}
+
+@TRACER.trace("delete_tweets")
+def delete_tweets(graph, tweet_ids, tombstone=False, search_index=None):
+    """
+    Apply a batch of deletions to the graph: delete the Tweet nodes with
+    these IDs (along with their relationships, taking back the counts those
+    added to their authors and the pages they cite), or if tombstone is
+    True, keep the nodes but remove their text and mark them deleted.
+    Either way their text is removed from the search index, if given, after
+    being handed on to any near-duplicates (see promote_duplicates).
+    Returns how many tweets were found.
+    """
+    promoted = promote_duplicates(graph, tweet_ids)
+    if search_index is not None:
+        for tweet_id, text in promoted.items():
+            if text is not None:
+                search_index.add("Tweet", tweet_id, None, text)
+    if tombstone:
+        properties = {"text": None, "archived": None, "deleted": time.time()}
+        if isinstance(graph, EmbeddedGraph):
+            found = graph.update_all("Tweet", "tweet_id", tweet_ids,
+                                     properties)
+        else:
+            found = graph.run("UNWIND $ids AS id "
+                              "MATCH (t:Tweet {tweet_id: id}) "
+                              "SET t += $properties "
+                              "RETURN count(t)",
+                              ids=tweet_ids,
+                              properties=properties).evaluate()
+    elif isinstance(graph, EmbeddedGraph):
+        found = graph.delete_all("Tweet", "tweet_id", tweet_ids,
+                                 {rel_type: (end,
+                                             counter + "_count",
+                                             counter + "_by_tweet")
+                                  for rel_type, (end, counter)
+                                  in TWEET_COUNTED.items()})
+    else:
+        # take back each count (leaving counts that are unset or already 0,
+        # as delete_all does), then delete
+        take_back = ("n.%(name)s = CASE WHEN n.%(name)s > 0 "
+                     "THEN n.%(name)s - 1 ELSE n.%(name)s END")
+        cypher = "UNWIND $ids AS id MATCH (t:Tweet {tweet_id: id}) "
+        for rel_type, (end, counter) in TWEET_COUNTED.items():
+            pattern = ("(n)-[:%s]->(t)" if end == "start" else
+                       "(t)-[:%s]->(n)") % rel_type
+            cypher += ("CALL { WITH t MATCH %s SET %s, %s } " %
+                       (pattern,
+                        take_back % {"name": counter + "_count"},
+                        take_back % {"name": counter + "_by_tweet"}))
+        cypher += "DETACH DELETE t RETURN count(*)"
+        found = graph.run(cypher, ids=tweet_ids).evaluate()
+    if search_index is not None:
+        for tweet_id in tweet_ids:
+            search_index.remove("Tweet", tweet_id)
+    return found
+
+def promote_duplicates(graph, tweet_ids):
+    """
+    Before deleting tweets, hand the text of each one that has near-duplicates
+    (stored without their own text) to the earliest of those not also being
+    deleted, which becomes the tweet the others are DUPLICATE_OF. Returns the
+    text (None if archived) of each promoted duplicate, by ID.
+    """
+    deleted = set(tweet_ids)
+    promoted = {}
+    if isinstance(graph, EmbeddedGraph):
+        found = graph.starts("DUPLICATE_OF", "Tweet", "tweet_id", tweet_ids)
+        for original_id, duplicates in found.items():
+            duplicates = sorted((node for node in duplicates
+                                 if node["tweet_id"] not in deleted),
+                                key=lambda node: node["tweet_id"])
+            if not duplicates:
+                continue
+            original = get_tweet_node_by_id(graph, original_id)
+            first = duplicates[0]
+            graph.separate(DUPLICATE_OF(first, original))
+            graph.update(first, {"text": original.get("text"),
+                                 "archived": original.get("archived"),
+                                 "duplicate_of": None})
+            for duplicate in duplicates[1:]:
+                graph.separate(DUPLICATE_OF(duplicate, original))
+                graph.merge(DUPLICATE_OF(duplicate, first))
+                graph.update(duplicate, {"duplicate_of": first["tweet_id"]})
+            promoted[first["tweet_id"]] = original.get("text")
+        return promoted
+    records = graph.run("UNWIND $ids AS id "
+                        "MATCH (d:Tweet)-[:DUPLICATE_OF]->"
+                        "(o:Tweet {tweet_id: id}) "
+                        "WHERE NOT d.tweet_id IN $ids "
+                        "WITH o, d ORDER BY d.tweet_id "
+                        "RETURN o.tweet_id, o.text, "
+                        "collect(d.tweet_id) AS duplicates",
+                        ids=tweet_ids)
+    for original_id, text, duplicates in records:
+        graph.run("MATCH (o:Tweet {tweet_id: $original}) "
+                  "MATCH (p:Tweet {tweet_id: $first})-[r:DUPLICATE_OF]->(o) "
+                  "DELETE r "
+                  "SET p.text = o.text, p.archived = o.archived "
+                  "REMOVE p.duplicate_of "
+                  "WITH o, p "
+                  "UNWIND $others AS id "
+                  "MATCH (d:Tweet {tweet_id: id})-[r:DUPLICATE_OF]->(o) "
+                  "DELETE r "
+                  "MERGE (d)-[:DUPLICATE_OF]->(p) "
+                  "SET d.duplicate_of = $first",
+                  original=original_id,
+                  first=duplicates[0],
+                  others=duplicates[1:])
+        promoted[duplicates[0]] = text
+    return promoted
 
 def link_tweets(graph, from_status, to_status):
     """
     Links two existing Tweet nodes, which must already exist in graph.
     Returns True if successfully linked, otherwise False.
     """
-    from_node = get_tweet_node(graph, from_status)
-    to_node = get_tweet_node(graph, to_status)
+    return link_tweet_ids(graph, from_status.id, to_status.id)
+
+def link_tweet_ids(graph, from_id, to_id):
+    """
+    Links two existing Tweet nodes by ID, which must already exist in graph.
+    Returns True if successfully linked, otherwise False.
+    """
+    from_node = get_tweet_node_by_id(graph, from_id)
+    to_node = get_tweet_node_by_id(graph, to_id)
     if from_node is not None and to_node is not None:
         links_to = LINKS_TO(from_node, to_node)
-        graph.merge(links_to)
-        True
-    else:
-        False
+        merge_counted(graph, links_to)
+        return True
+    return False
 
-def reddit_to_neo4j(graph, submission):
+def reddit_to_neo4j(graph, submission, notability=None, search_index=None):
     """
     Given a JSON rep of a reddit submission, add it to the Neo4j database
-    (or update)
+    (or update), along with its notability score if it has one. If a search
+    index is given, the title and text are indexed there too.
     """
     reddit_submission = RedditSubmission(submission.created_utc,
                                          submission.id,
@@ -86,8 +321,14 @@ def reddit_to_neo4j(graph, submission):
                                          submission.selftext,
                                          submission.subreddit.display_name,
                                          submission.title,
-                                         submission.upvote_ratio)
+                                         submission.upvote_ratio,
+                                         notability)
     reddit_submission.add_to(graph)
+    if search_index is not None:
+        search_index.add("RedditSubmission",
+                         submission.id,
+                         submission.title,
+                         submission.selftext)
     # print("added reddit submission")
     user = Redditor(submission.author.comment_karma,
                     submission.author.created_utc,
@@ -98,9 +339,72 @@ def reddit_to_neo4j(graph, submission):
                     submission.author.name)
     user.add_to(graph)
     authored = AUTHORED(user, reddit_submission)
-    graph.merge(authored)
+    merge_counted(graph, authored, counted="start", counter="authored")
     return (user, reddit_submission, authored)
 
+def get_reddit_submission_node(graph, submission_id):
+    """
+    Search for a RedditSubmission node in the graph with this ID, and return
+    it if it exists (otherwise None).
+    """
+    return graph.nodes.match("RedditSubmission",
+                             submission_id=submission_id).first()
+
+def partial_redditor_to_node(fullname, partial=None):
+    """
+    A Redditor node for the author with this fullname (t2_...), with what a
+    PartialRedditor tells of them, if given. Properties it doesn't have are
+    left out, so that merging the node keeps any stored values.
+    """
+    user = Redditor(getattr(partial, "comment_karma", None),
+                    getattr(partial, "created_utc", None),
+                    None,
+                    fullname[3:],
+                    None,
+                    getattr(partial, "link_karma", None),
+                    getattr(partial, "name", None))
+    for name in [name for name, value in user.items() if value is None]:
+        del user[name]
+    return user
+
+@TRACER.trace("comments_to_neo4j")
+def comments_to_neo4j(graph, submission_id, comments, authors=None,
+                      search_index=None):
+    """
+    Add a micro-batch of Reddit comments on one submission to the graph,
+    each linked to the submission (if it is in the graph, counted in its
+    reply_count) and authored by its author. authors maps author fullnames
+    to PartialRedditors, for authors whose details are to be stored. If a
+    search index is given, the comments are indexed there too. Returns the
+    comments' nodes.
+    """
+    authors = authors or {}
+    submission = get_reddit_submission_node(graph, submission_id)
+    nodes = []
+    for comment in comments:
+        node = RedditComment(comment.body,
+                             comment.created_utc,
+                             comment.id,
+                             comment.is_submitter,
+                             comment.permalink,
+                             comment.score,
+                             comment.subreddit.display_name)
+        node.add_to(graph)
+        if search_index is not None:
+            search_index.add("RedditComment", comment.id, None, comment.body)
+        if submission is not None:
+            # replies are counted apart from citations (cited_count)
+            merge_counted(graph, LINKS_TO(node, submission), counter="reply")
+        # deleted authors have no fullname
+        fullname = getattr(comment, "author_fullname", None)
+        if fullname is not None:
+            user = partial_redditor_to_node(fullname, authors.get(fullname))
+            user.add_to(graph)
+            authored = AUTHORED(user, node)
+            merge_counted(graph, authored, counted="start", counter="authored")
+        nodes.append(node)
+    return nodes
+
 # def link_reddit_to_webpage(graph, submission, url):
 #     """
 #     Link reddit submission to a webpage, which must already exist in graph.
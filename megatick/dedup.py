@@ -0,0 +1,133 @@
+"""
+Streaming near-duplicate detection for texts (tweets, scraped pages) using
+MinHash signatures and a locality-sensitive (banded) index, with memory
+bounded by a time window and a maximum number of fingerprints.
+"""
+
+from collections import deque
+import re
+import time
+from threading import Lock
+
+import numpy as np
+
+# a prime just above 2**32, so (a * x + b) fits in 64 bits for 32-bit x
+PRIME = np.uint64(4294967311)
+
+class NearDuplicateIndex:
+    """
+    Remember fingerprints of recently seen texts and report when a new text
+    is a near-duplicate (estimated Jaccard similarity of word shingles of at
+    least threshold) of one of them.
+    """
+    def __init__(self,
+                 threshold=0.8,
+                 window=24.0,
+                 max_items=100000,
+                 num_perm=64,
+                 bands=8,
+                 shingle_size=3,
+                 min_tokens=8,
+                 seed=1):
+        self.threshold = threshold
+        # hours a fingerprint is remembered for
+        self.window = window * 3600
+        self.max_items = max_items
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # texts shorter than this are too short to call duplicates
+        self.min_tokens = min_tokens
+
+        rng = np.random.default_rng(seed)
+        self.coef_a = rng.integers(1, 2**32, num_perm, dtype=np.uint64)
+        self.coef_b = rng.integers(0, 2**32, num_perm, dtype=np.uint64)
+
+        self.lock = Lock()
+        # key -> signature, band buckets -> keys, and (time, key) by age
+        self.signatures = {}
+        self.buckets = {}
+        self.ages = deque()
+
+    def fingerprint(self, text):
+        """Return the MinHash signature of text, or None if too short"""
+        tokens = re.findall(r"\w+", text.lower())
+        if len(tokens) < self.min_tokens:
+            return None
+        shingles = {" ".join(tokens[i:i + self.shingle_size])
+                    for i in range(len(tokens) - self.shingle_size + 1)}
+        hashes = np.fromiter((hash(shingle) & 0xFFFFFFFF
+                              for shingle in shingles),
+                             dtype=np.uint64,
+                             count=len(shingles))
+        permuted = (np.outer(hashes, self.coef_a) + self.coef_b) % PRIME
+        return permuted.min(axis=0)
+
+    def band_keys(self, signature):
+        """Return the LSH bucket keys of a signature, one per band"""
+        return [(band, signature[band * self.rows:
+                                 (band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def evict(self, now):
+        """Forget fingerprints older than the window or beyond max_items"""
+        while self.ages and (now - self.ages[0][0] > self.window or
+                             len(self.ages) > self.max_items):
+            _, key = self.ages.popleft()
+            signature = self.signatures.pop(key)
+            for band_key in self.band_keys(signature):
+                bucket = self.buckets[band_key]
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band_key]
+
+    def check(self, key, text):
+        """
+        If text is a near-duplicate of a remembered text, return that text's
+        key. Otherwise remember text under key and return None.
+        """
+        if text is None:
+            return None
+        signature = self.fingerprint(text)
+        if signature is None:
+            return None
+        band_keys = self.band_keys(signature)
+
+        with self.lock:
+            now = time.time()
+            self.evict(now)
+
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self.buckets.get(band_key, ()))
+            candidates.discard(key)
+            for candidate in candidates:
+                similarity = np.mean(self.signatures[candidate] == signature)
+                if similarity >= self.threshold:
+                    return candidate
+
+            if key not in self.signatures:
+                self.signatures[key] = signature
+                self.ages.append((now, key))
+                for band_key in band_keys:
+                    self.buckets.setdefault(band_key, set()).add(key)
+            return None
+
+def create_dedup_index(conf):
+    """
+    Create a NearDuplicateIndex configured from conf, or None if near-
+    duplicate detection is switched off (DEFAULT.nearDuplicates).
+    """
+    if (conf.has_option("DEFAULT", "nearDuplicates") and
+            not conf.getboolean("DEFAULT", "nearDuplicates")):
+        return None
+    threshold = 0.8
+    if conf.has_option("DEFAULT", "dedupThreshold"):
+        threshold = conf.getfloat("DEFAULT", "dedupThreshold")
+    window = 24.0
+    if conf.has_option("DEFAULT", "dedupWindow"):
+        window = conf.getfloat("DEFAULT", "dedupWindow")
+    max_items = 100000
+    if conf.has_option("DEFAULT", "dedupMaxItems"):
+        max_items = conf.getint("DEFAULT", "dedupMaxItems")
+    return NearDuplicateIndex(threshold, window, max_items)
@@ -0,0 +1,176 @@
+"""
+Handling of Twitter delete notices. Notices are buffered and applied in
+batches by their own thread, so that ingestion never waits on them. Each
+deleted tweet ID is added to a tombstone index, which tools replaying stored
+or fetched tweets (CSV segments, backfills) consult to leave them out.
+"""
+
+import os
+import time
+from queue import Queue
+from threading import Lock, Thread
+
+import numpy as np
+
+from megatick.database import delete_tweets
+from megatick.utils import drain_queue
+
+# tweet IDs are stored as unsigned 64-bit integers (little-endian)
+ID_TYPE = np.dtype("<u8")
+
+class TombstoneIndex:
+    """
+    IDs of deleted tweets, appended to a file of packed 64-bit IDs (8 bytes
+    each). In memory they are kept in a sorted array, searched by bisection,
+    plus a set of IDs added since, which is merged into the array once it
+    holds merge_size IDs.
+    """
+    def __init__(self, location, merge_size=10000):
+        self.location = location
+        self.merge_size = merge_size
+        self.lock = Lock()
+        self.ids = np.zeros(0, dtype=ID_TYPE)
+        self.pending = set()
+        if os.path.exists(location):
+            with open(location, "rb") as in_file:
+                data = in_file.read()
+            # ignore any partly written ID at the end
+            data = data[:len(data) - len(data) % ID_TYPE.itemsize]
+            self.ids = np.unique(np.frombuffer(data, dtype=ID_TYPE))
+
+    def __contains__(self, tweet_id):
+        tweet_id = int(tweet_id)
+        # read pending first: a merge replaces the array before the set
+        if tweet_id in self.pending:
+            return True
+        ids = self.ids
+        # (as uint64, since mixing it with a Python int goes through floats)
+        key = np.uint64(tweet_id)
+        index = np.searchsorted(ids, key)
+        return bool(index < len(ids) and ids[index] == key)
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def add(self, tweet_ids):
+        """Add a batch of IDs, flushed to disk before returning"""
+        with self.lock:
+            new_ids = {tweet_id for tweet_id in map(int, tweet_ids)
+                       if tweet_id not in self}
+            if not new_ids:
+                return
+            with open(self.location, "ab") as out_file:
+                out_file.write(np.array(sorted(new_ids),
+                                        dtype=ID_TYPE).tobytes())
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            pending = self.pending | new_ids
+            if len(pending) >= self.merge_size:
+                self.ids = np.union1d(self.ids,
+                                      np.array(list(pending), dtype=ID_TYPE))
+                pending = set()
+            # replaced rather than changed, as readers don't take the lock
+            self.pending = pending
+
+# one index per location, shared by everything in this process
+TOMBSTONES = {}
+TOMBSTONES_LOCK = Lock()
+
+def create_tombstone_index(conf):
+    """
+    Return the TombstoneIndex at twitter.tombstonesLoc (default
+    tombstones.bin)
+    """
+    location = "tombstones.bin"
+    if conf.has_option("twitter", "tombstonesLoc"):
+        location = conf.get("twitter", "tombstonesLoc")
+    with TOMBSTONES_LOCK:
+        if location not in TOMBSTONES:
+            TOMBSTONES[location] = TombstoneIndex(location)
+        return TOMBSTONES[location]
+
+class DeleteBuffer:
+    """
+    Collects deleted tweet IDs and, every twitter.deleteInterval seconds
+    (default 5), applies those waiting, up to twitter.deleteBatchSize
+    (default 1000) at a time: first to the tombstone index, then to the
+    graph (if any) through the graph writers. twitter.deleteMode chooses
+    whether tweets are deleted from the graph ("delete", the default) or
+    kept without their text ("tombstone").
+    """
+    def __init__(self, conf, tombstones, graph=None, writer=None,
+                 search_index=None):
+        self.tombstones = tombstones
+        self.graph = graph
+        self.writer = writer
+        self.search_index = search_index
+
+        self.interval = 5.0
+        if conf.has_option("twitter", "deleteInterval"):
+            self.interval = conf.getfloat("twitter", "deleteInterval")
+        self.batch_size = 1000
+        if conf.has_option("twitter", "deleteBatchSize"):
+            self.batch_size = conf.getint("twitter", "deleteBatchSize")
+        self.tombstone = False
+        if conf.has_option("twitter", "deleteMode"):
+            mode = conf.get("twitter", "deleteMode")
+            if mode not in ("delete", "tombstone"):
+                raise ValueError("Unknown delete mode: " + mode)
+            self.tombstone = mode == "tombstone"
+
+        self.queue = Queue(maxsize=0)
+        thread = Thread(target=self.apply_deletes, daemon=True)
+        thread.start()
+
+    def put(self, tweet_id):
+        """Note a deleted tweet, to be applied with the next batch"""
+        self.queue.put(tweet_id)
+
+    def apply_deletes(self):
+        """Apply waiting deletions in batches (run in its own thread)"""
+        while True:
+            tweet_ids = drain_queue(self.queue, self.batch_size)
+            try:
+                self.apply(tweet_ids)
+            except Exception as error:
+                print("Error apply_deletes: %s" % str(error))
+            for _ in tweet_ids:
+                self.queue.task_done()
+            # let the next batch build up, unless this one was full, in
+            # which case more are already waiting
+            if len(tweet_ids) < self.batch_size:
+                time.sleep(self.interval)
+
+    def write_live(self, tweet_id, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs), a write of the tweet with this ID,
+        unless the tweet has been deleted. Writes and deletions are routed
+        to different graph writers, so a deletion may be applied before a
+        write of the tweet already waiting, or during it; a tweet deleted by
+        the end of its write is deleted again. Returns the function's result,
+        or None if not written (or deleted again).
+        """
+        if tweet_id in self.tombstones:
+            return None
+        result = function(*args, **kwargs)
+        if tweet_id in self.tombstones:
+            delete_tweets(self.graph,
+                          [tweet_id],
+                          tombstone=self.tombstone,
+                          search_index=self.search_index)
+            return None
+        return result
+
+    def apply(self, tweet_ids):
+        """Apply one batch of deletions"""
+        self.tombstones.add(tweet_ids)
+        if self.graph is not None:
+            # all batches go to the same writer, so they apply in order
+            found = self.writer.call("delete_tweets",
+                                     delete_tweets,
+                                     self.graph,
+                                     tweet_ids,
+                                     tombstone=self.tombstone,
+                                     search_index=self.search_index)
+            print("Applied %d deletions (%d tweets in graph)" %
+                  (len(tweet_ids), found))
@@ -0,0 +1,51 @@
+"""
+In-process DNS cache: wraps socket.getaddrinfo so that repeated requests to
+the same host reuse its addresses for a time, rather than each connection
+attempt repeating the lookup.
+"""
+
+import socket
+import time
+from threading import Lock
+
+class DnsCache:
+    """getaddrinfo results by arguments, each kept for ttl seconds"""
+    def __init__(self, getaddrinfo, ttl=300.0, maxsize=10000):
+        self.getaddrinfo = getaddrinfo
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = {}
+        self.lock = Lock()
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        # failures are not cached, so they raise as usual
+        result = self.getaddrinfo(*args, **kwargs)
+        with self.lock:
+            if len(self.entries) >= self.maxsize:
+                # forget expired entries, or everything if none have expired
+                self.entries = {key: entry
+                                for key, entry in self.entries.items()
+                                if entry[0] > now}
+                if len(self.entries) >= self.maxsize:
+                    self.entries = {}
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+def install_dns_cache(conf):
+    """
+    Cache DNS lookups in this process for DEFAULT.dnsCacheTtl seconds
+    (default 300, 0 to not cache). Only the first call has any effect.
+    """
+    if isinstance(socket.getaddrinfo, DnsCache):
+        return
+    ttl = 300.0
+    if conf.has_option("DEFAULT", "dnsCacheTtl"):
+        ttl = conf.getfloat("DEFAULT", "dnsCacheTtl")
+    if ttl > 0:
+        socket.getaddrinfo = DnsCache(socket.getaddrinfo, ttl)
@@ -0,0 +1,401 @@
+"""
+Embedded, file-backed (SQLite) stand-in for a Neo4j Graph, implementing the
+node and relationship operations Megatick uses (merge by key, match by key,
+link, push), so that monitors can run without a Neo4j server.
+"""
+
+from datetime import date, datetime
+import json
+import sqlite3
+from threading import RLock
+
+from py2neo import Node, Relationship
+
+def encode(value):
+    """JSON encoding for property values that JSON can't represent"""
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    raise TypeError("can't store %r" % (value,))
+
+def decode(obj):
+    """Reverse encode() when loading properties"""
+    if "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    if "$date" in obj:
+        return date.fromisoformat(obj["$date"])
+    return obj
+
+def dumps(value):
+    """Serialize properties (or a key) to a string"""
+    return json.dumps(value, default=encode, sort_keys=True)
+
+def loads(text):
+    """Deserialize properties (or a key) from a string"""
+    return json.loads(text, object_hook=decode)
+
+class EmbeddedMatch:
+    """Lazily evaluated node match, like py2neo's NodeMatch"""
+    def __init__(self, graph, label, properties):
+        self.graph = graph
+        self.label = label
+        self.properties = properties
+
+    def __iter__(self):
+        return iter(self.graph.find(self.label, self.properties))
+
+    def first(self):
+        """Return the first matching node, or None"""
+        for node in self.graph.find(self.label, self.properties, limit=1):
+            return node
+        return None
+
+    def all(self):
+        """Return a list of all matching nodes"""
+        return list(self)
+
+    def count(self):
+        """Return the number of matching nodes"""
+        return len(self.all())
+
+class EmbeddedMatcher:
+    """Finds nodes by label and properties, like py2neo's NodeMatcher"""
+    def __init__(self, graph):
+        self.graph = graph
+
+    def match(self, label, **properties):
+        """Match nodes with this label and these property values"""
+        return EmbeddedMatch(self.graph, label, properties)
+
+class EmbeddedGraph:
+    """A graph of merged nodes and relationships stored in a SQLite file"""
+    def __init__(self, location):
+        # py2neo identifies bound nodes by graph service, name and identity
+        self.service = self
+        self.name = location
+
+        self.lock = RLock()
+        self.connection = sqlite3.connect(location,
+                                          timeout=30,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS nodes "
+                                    "(id INTEGER PRIMARY KEY, "
+                                    "label TEXT NOT NULL, "
+                                    "key_name TEXT NOT NULL, "
+                                    "key TEXT NOT NULL, "
+                                    "properties TEXT NOT NULL, "
+                                    "UNIQUE (label, key_name, key))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS relationships "
+                                    "(type TEXT NOT NULL, "
+                                    "start INTEGER NOT NULL, "
+                                    "end INTEGER NOT NULL, "
+                                    "properties TEXT NOT NULL, "
+                                    "PRIMARY KEY (type, start, end))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS "
+                                    "relationships_end "
+                                    "ON relationships (end, type)")
+        self.nodes = EmbeddedMatcher(self)
+        # key property name by label, e.g. "url" for WebPage
+        self.key_names = {}
+
+    def bind(self, node, identity, label, key_name):
+        """Associate a Node object with its stored row"""
+        node.graph = self
+        node.identity = identity
+        node.__primarylabel__ = label
+        node.__primarykey__ = key_name
+
+    def node_from_row(self, identity, label, key_name, properties):
+        """Build a bound Node from a stored row"""
+        node = Node(label, **loads(properties))
+        self.bind(node, identity, label, key_name)
+        return node
+
+    def merge(self, subgraph, label=None, key_name=None):
+        """
+        Merge a node (by label and key) or a relationship (by type and end
+        nodes) into the graph, creating it or updating its properties.
+        Returns True if it was created.
+        """
+        if isinstance(subgraph, Relationship):
+            return self.merge_relationship(subgraph)
+        return self.merge_node(subgraph, label, key_name)
+
+    def merge_node(self, node, label=None, key_name=None):
+        """Merge a node by label and key. Returns True if it was created."""
+        if label is None:
+            label = node.__primarylabel__
+        if key_name is None:
+            key_name = node.__primarykey__
+        key = dumps(node[key_name])
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id, properties FROM nodes "
+                                          "WHERE label = ? AND key_name = ? "
+                                          "AND key = ?",
+                                          (label, key_name, key)).fetchone()
+            if row is None:
+                identity = self.connection.execute(
+                    "INSERT INTO nodes (label, key_name, key, properties) "
+                    "VALUES (?, ?, ?, ?)",
+                    (label, key_name, key, dumps(dict(node)))).lastrowid
+            else:
+                identity = row[0]
+                properties = loads(row[1])
+                properties.update(node)
+                self.connection.execute("UPDATE nodes SET properties = ? "
+                                        "WHERE id = ?",
+                                        (dumps(properties), identity))
+        self.key_names[label] = key_name
+        self.bind(node, identity, label, key_name)
+        return row is None
+
+    def node_id(self, node):
+        """The stored ID of a node, merging it first if it is not bound"""
+        if getattr(node, "graph", None) is not self or node.identity is None:
+            self.merge_node(node)
+        return node.identity
+
+    def merge_relationship(self, relationship):
+        """
+        Merge a relationship between two nodes. Returns True if it was
+        created.
+        """
+        rel_type = type(relationship).__name__
+        start = self.node_id(relationship.start_node)
+        end = self.node_id(relationship.end_node)
+        with self.lock, self.connection:
+            cursor = self.connection.execute("INSERT OR IGNORE INTO "
+                                             "relationships VALUES "
+                                             "(?, ?, ?, ?)",
+                                             (rel_type, start, end,
+                                              dumps(dict(relationship))))
+        return cursor.rowcount == 1
+
+    def separate(self, relationship):
+        """Delete a relationship between two stored nodes, if it exists"""
+        start = self.node_id(relationship.start_node)
+        end = self.node_id(relationship.end_node)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM relationships WHERE "
+                                    "type = ? AND start = ? AND end = ?",
+                                    (type(relationship).__name__, start, end))
+
+    def starts(self, rel_type, label, key_name, keys):
+        """
+        Return, for each of these keys of nodes with this label, the nodes
+        with a rel_type relationship to it (omitting keys with none)
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                rows = self.connection.execute(
+                    "SELECT s.id, s.label, s.key_name, s.properties "
+                    "FROM nodes AS e JOIN relationships AS r ON r.end = e.id "
+                    "JOIN nodes AS s ON s.id = r.start "
+                    "WHERE e.label = ? AND e.key_name = ? AND e.key = ? "
+                    "AND r.type = ?",
+                    (label, key_name, dumps(key), rel_type)).fetchall()
+                if rows:
+                    found[key] = [self.node_from_row(*row) for row in rows]
+        return found
+
+    def merge_counted(self, relationship, node, names, now):
+        """
+        Merge a relationship and, if it was created, count it on node (its
+        start or end node), in one transaction. names gives the property
+        names of the count, the count by source, and the first and last
+        times. Returns whether it was created, and node's stored properties.
+        """
+        start = self.node_id(relationship.start_node)
+        end = self.node_id(relationship.end_node)
+        with self.lock, self.connection:
+            created = self.connection.execute(
+                "INSERT OR IGNORE INTO relationships VALUES (?, ?, ?, ?)",
+                (type(relationship).__name__, start, end,
+                 dumps(dict(relationship)))).rowcount == 1
+            identity = start if node is relationship.start_node else end
+            properties = loads(self.connection.execute(
+                "SELECT properties FROM nodes WHERE id = ?",
+                (identity,)).fetchone()[0])
+            if created:
+                properties[names["count"]] = (
+                    properties.get(names["count"], 0) + 1)
+                properties[names["by"]] = properties.get(names["by"], 0) + 1
+                properties.setdefault(names["first"], now)
+                properties[names["last"]] = now
+                self.connection.execute("UPDATE nodes SET properties = ? "
+                                        "WHERE id = ?",
+                                        (dumps(properties), identity))
+        return created, properties
+
+    def create_index(self, name):
+        """Index nodes by label and a (numeric) property"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS nodes_%s ON nodes "
+                "(label, json_extract(properties, '$.%s'))" % (name, name))
+
+    def top(self, label, name, limit=10):
+        """Return up to limit nodes with this label, highest name first"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, label, key_name, properties FROM nodes "
+                "WHERE label = ? AND json_extract(properties, '$.%s') "
+                "IS NOT NULL ORDER BY json_extract(properties, '$.%s') DESC "
+                "LIMIT ?" % (name, name), (label, limit)).fetchall()
+        return [self.node_from_row(*row) for row in rows]
+
+    def push(self, node):
+        """Store the current properties of a bound node"""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE nodes SET properties = ? "
+                                    "WHERE id = ?",
+                                    (dumps(dict(node)), self.node_id(node)))
+
+    def update(self, node, properties):
+        """
+        Set (or, with None, remove) some properties of a stored node,
+        leaving its others as they are
+        """
+        identity = self.node_id(node)
+        with self.lock, self.connection:
+            stored = loads(self.connection.execute(
+                "SELECT properties FROM nodes WHERE id = ?",
+                (identity,)).fetchone()[0])
+            for name, value in properties.items():
+                if value is None:
+                    stored.pop(name, None)
+                else:
+                    stored[name] = value
+            self.connection.execute("UPDATE nodes SET properties = ? "
+                                    "WHERE id = ?",
+                                    (dumps(stored), identity))
+        node.update(properties)
+
+    def update_all(self, label, key_name, keys, properties):
+        """
+        Set (or, with None, remove) some properties of the stored nodes
+        with this label and these keys, in one transaction. Returns how many
+        were found.
+        """
+        found = 0
+        with self.lock, self.connection:
+            for key in keys:
+                row = self.connection.execute(
+                    "SELECT id, properties FROM nodes WHERE label = ? AND "
+                    "key_name = ? AND key = ?",
+                    (label, key_name, dumps(key))).fetchone()
+                if row is None:
+                    continue
+                stored = loads(row[1])
+                for name, value in properties.items():
+                    if value is None:
+                        stored.pop(name, None)
+                    else:
+                        stored[name] = value
+                self.connection.execute("UPDATE nodes SET properties = ? "
+                                        "WHERE id = ?",
+                                        (dumps(stored), row[0]))
+                found += 1
+        return found
+
+    def delete_all(self, label, key_name, keys, counted=None):
+        """
+        Delete the stored nodes with this label and these keys, and their
+        relationships, in one transaction. counted maps relationship types
+        to (counted end, count name, count by source name): for each such
+        relationship deleted, the count on the node at that end (when it is
+        not itself deleted) is taken back. Returns how many were deleted.
+        """
+        counted = counted or {}
+        deleted = 0
+        with self.lock, self.connection:
+            for key in keys:
+                row = self.connection.execute(
+                    "SELECT id FROM nodes WHERE label = ? AND key_name = ? "
+                    "AND key = ?",
+                    (label, key_name, dumps(key))).fetchone()
+                if row is None:
+                    continue
+                identity = row[0]
+                relationships = self.connection.execute(
+                    "SELECT type, start, end FROM relationships "
+                    "WHERE start = ? OR end = ?",
+                    (identity, identity)).fetchall()
+                for rel_type, start, end in relationships:
+                    if rel_type not in counted:
+                        continue
+                    counted_end, count_name, by_name = counted[rel_type]
+                    other = start if counted_end == "start" else end
+                    if other == identity:
+                        continue
+                    stored = loads(self.connection.execute(
+                        "SELECT properties FROM nodes WHERE id = ?",
+                        (other,)).fetchone()[0])
+                    for name in (count_name, by_name):
+                        if stored.get(name, 0) > 0:
+                            stored[name] -= 1
+                    self.connection.execute("UPDATE nodes SET properties = ? "
+                                            "WHERE id = ?",
+                                            (dumps(stored), other))
+                self.connection.execute("DELETE FROM relationships "
+                                        "WHERE start = ? OR end = ?",
+                                        (identity, identity))
+                self.connection.execute("DELETE FROM nodes WHERE id = ?",
+                                        (identity,))
+                deleted += 1
+        return deleted
+
+    def scan(self, label, name, after=0, limit=1000):
+        """
+        Return up to limit nodes with this label and a value for property
+        name, with IDs above after, in ID order
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, label, key_name, properties FROM nodes "
+                "WHERE label = ? AND id > ? AND "
+                "json_extract(properties, '$.%s') IS NOT NULL "
+                "ORDER BY id LIMIT ?" % name,
+                (label, after, limit)).fetchall()
+        return [self.node_from_row(*row) for row in rows]
+
+    def key_name(self, label):
+        """The name of the key property of nodes with this label, if any"""
+        if label not in self.key_names:
+            with self.lock:
+                row = self.connection.execute("SELECT key_name FROM nodes "
+                                              "WHERE label = ? LIMIT 1",
+                                              (label,)).fetchone()
+            if row is None:
+                return None
+            self.key_names[label] = row[0]
+        return self.key_names[label]
+
+    def find(self, label, properties, limit=None):
+        """Yield nodes with this label and these property values"""
+        key_name = self.key_name(label)
+        with self.lock:
+            if key_name is not None and key_name in properties:
+                # look up by key, then check any other properties
+                rows = self.connection.execute(
+                    "SELECT id, label, key_name, properties FROM nodes "
+                    "WHERE label = ? AND key_name = ? AND key = ?",
+                    (label, key_name, dumps(properties[key_name]))).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT id, label, key_name, properties FROM nodes "
+                    "WHERE label = ?", (label,)).fetchall()
+        found = 0
+        for row in rows:
+            node = self.node_from_row(*row)
+            if all(node.get(name) == value
+                   for name, value in properties.items()):
+                yield node
+                found += 1
+                if limit is not None and found >= limit:
+                    return
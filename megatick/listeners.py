@@ -3,32 +3,49 @@ Custom listeners for monitoring cybersecurity tweets.
 """
 
 import configparser
-import csv
-import os
 import sys
 import time
 
-from http.client import IncompleteRead as http_incompleteRead
 from queue import Queue
 from threading import Thread
-from urllib3.exceptions import IncompleteRead as urllib3_incompleteRead
 
 import tweepy
 
-from megatick.database import tweet_to_neo4j, link_tweets, get_tweet_node
+# a faster JSON parser, if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from megatick.csvsink import RotatingCsvWriter
+from megatick.database import (tweet_to_neo4j, link_tweets, link_tweet_ids,
+                               get_tweet_node, get_tweet_node_by_id)
+from megatick.dedup import create_dedup_index
+from megatick.deletes import DeleteBuffer, create_tombstone_index
+from megatick.notability import TweetBlacklistModel, create_tweet_model
+from megatick.records import StatusRecord
 from megatick.scraper import Scraper
-from megatick.utils import get_full_text, get_urls, tweet_is_notable
+from megatick.search import create_search_index
+from megatick.tracing import TRACER
+from megatick.utils import (RecentSet, drain_queue, get_full_text, get_urls,
+                            read_blacklists, watch_files)
+from megatick.writer import create_graph_writer
 
 class MegatickStreamListener(tweepy.StreamListener):
     """A tweepy StreamListener with custom error handling."""
-    def __init__(self, api=None, graph=None, prefix=None):
+    def __init__(self, api=None, graph=None, prefix=None, conf=None,
+                 scraper=None):
         """Initialize MegatickStreamListener"""
         super().__init__(api=api)
         print("Initializing listener")
 
-        # load configuration
-        self.conf = configparser.ConfigParser()
-        self.conf.read("config.ini")
+        # load default conf if none is provided
+        if conf is None:
+            # load default configuration
+            self.conf = configparser.ConfigParser()
+            self.conf.read("config.ini")
+        else:
+            self.conf = conf
 
         # Neo4j database graph or None
         self.graph = graph
@@ -36,128 +53,230 @@ class MegatickStreamListener(tweepy.StreamListener):
         # status_queue (single-threaded) for handling tweets as they come in
         # without binding up
         self.status_queue = Queue(maxsize=0)
-        status_thread = Thread(target=self.record_status)
-        status_thread.start()
 
-        # read list of blacklisted user IDs to filter out.
-        # NB: long numbers (stored as strings) rather than handles which change
-        self.user_blacklist = None
-        if self.conf.has_option("twitter", "userBlacklistLoc"):
-            user_blacklist_loc = self.conf.get("twitter", "userBlacklistLoc")
-            with open(user_blacklist_loc, "r") as bl_file:
-                self.user_blacklist = [line.strip() for line in bl_file]
-
-        # read list of blacklisted terms and join them using | (or) for regex
-        # searches
-        self.kw_blacklist = None
-        if self.conf.has_option("twitter", "keywordBlacklistLoc"):
-            kw_blacklist_loc = self.conf.get("twitter", "keywordBlacklistLoc")
-            with open(kw_blacklist_loc, "r") as bl_file:
-                pieces = [line.strip() for line in bl_file]
-                self.kw_blacklist = "|".join(pieces)
+        # blacklists, and the models applying them, reloaded whenever the
+        # blacklist files change
+        self.load_blacklists()
+        watch_files(self.conf,
+                    [self.conf.get("twitter", "userBlacklistLoc",
+                                   fallback=None),
+                     self.conf.get("twitter", "keywordBlacklistLoc",
+                                   fallback=None)],
+                    self.load_blacklists)
+
+        # statuses are scored for notability in micro-batches of up to
+        # batch_size statuses at a time
+        self.batch_size = 100
+        if self.conf.has_option("twitter", "batchSize"):
+            self.batch_size = self.conf.getint("twitter", "batchSize")
+
+        # IDs of recently streamed tweets, so that a tweet matching the
+        # filters of more than one stream connection is only handled once
+        seen_size = 100000
+        if self.conf.has_option("twitter", "seenTweetsSize"):
+            seen_size = self.conf.getint("twitter", "seenTweetsSize")
+        self.seen_tweets = RecentSet(seen_size)
+
+        # IDs of deleted tweets, which are not recorded (or replayed)
+        self.tombstones = create_tombstone_index(self.conf)
 
         # if no graph, then print header to csv
         if self.graph is None:
             output_location = self.conf.get("twitter", "tweetsLoc")
             print("printing csv to " + output_location)
 
-            # establish a filename with the current datetime
-            filename = time.strftime("%Y-%m-%dT%H-%M-%S") + ".csv"
-            if prefix is not None:
-                filename = prefix + "_" + filename
-
-            # Create a new file with that filename
-            self.csv_file = open(os.path.join(output_location, filename), "w")
-
-            # create a csv writer
-            self.csv_writer = csv.writer(self.csv_file)
-
-            # write a single row with the headers of the columns
-            self.csv_writer.writerow(["text",
-                                      "created_at",
-                                      "geo",
-                                      "lang",
-                                      "place",
-                                      "coordinates",
-                                      "user.favourites_count",
-                                      "user.statuses_count",
-                                      "user.description",
-                                      "user.location",
-                                      "user.id",
-                                      "user.created_at",
-                                      "user.verified",
-                                      "user.following",
-                                      "user.url",
-                                      "user.listed_count",
-                                      "user.followers_count",
-                                      "user.default_profile_image",
-                                      "user.utc_offset",
-                                      "user.friends_count",
-                                      "user.default_profile",
-                                      "user.name",
-                                      "user.lang",
-                                      "user.screen_name",
-                                      "user.geo_enabled",
-                                      "user.time_zone",
-                                      "id",
-                                      "favorite_count",
-                                      "retweeted",
-                                      "source",
-                                      "favorited",
-                                      "retweet_count"])
-
-            # flush to force writing
-            self.csv_file.flush()
+            # rotation and compression of the CSV segments
+            compression = "gzip"
+            if self.conf.has_option("twitter", "csvCompression"):
+                compression = self.conf.get("twitter", "csvCompression")
+            max_bytes = 100 * 1024 * 1024
+            if self.conf.has_option("twitter", "csvMaxBytes"):
+                max_bytes = self.conf.getint("twitter", "csvMaxBytes")
+            max_age = 24 * 60 * 60
+            if self.conf.has_option("twitter", "csvMaxAge"):
+                max_age = self.conf.getfloat("twitter", "csvMaxAge") * 60 * 60
+            flush_rows = 1000
+            if self.conf.has_option("twitter", "csvFlushRows"):
+                flush_rows = self.conf.getint("twitter", "csvFlushRows")
+            flush_interval = 10.0
+            if self.conf.has_option("twitter", "csvFlushInterval"):
+                flush_interval = self.conf.getfloat("twitter",
+                                                    "csvFlushInterval")
+
+            # segments begin with a single row with the headers of the columns
+            self.csv_writer = RotatingCsvWriter(output_location,
+                                                ["text",
+                                                 "created_at",
+                                                 "geo",
+                                                 "lang",
+                                                 "place",
+                                                 "coordinates",
+                                                 "user.favourites_count",
+                                                 "user.statuses_count",
+                                                 "user.description",
+                                                 "user.location",
+                                                 "user.id",
+                                                 "user.created_at",
+                                                 "user.verified",
+                                                 "user.following",
+                                                 "user.url",
+                                                 "user.listed_count",
+                                                 "user.followers_count",
+                                                 "user.default_profile_image",
+                                                 "user.utc_offset",
+                                                 "user.friends_count",
+                                                 "user.default_profile",
+                                                 "user.name",
+                                                 "user.lang",
+                                                 "user.screen_name",
+                                                 "user.geo_enabled",
+                                                 "user.time_zone",
+                                                 "id",
+                                                 "favorite_count",
+                                                 "retweeted",
+                                                 "source",
+                                                 "favorited",
+                                                 "retweet_count"],
+                                                prefix=prefix,
+                                                compression=compression,
+                                                max_bytes=max_bytes,
+                                                max_age=max_age,
+                                                flush_rows=flush_rows,
+                                                flush_interval=flush_interval)
+
+            # deletions can only be noted for later readers of the CSVs
+            self.deletes = DeleteBuffer(self.conf, self.tombstones)
 
         # when using Neo4j graph, also retrieve sites and twitter threads
         else:
+            # IDs of tweets known to be in the graph, so that threads are not
+            # fetched again from the API
+            known_size = 100000
+            if self.conf.has_option("twitter", "knownTweetsSize"):
+                known_size = self.conf.getint("twitter", "knownTweetsSize")
+            self.known_tweets = RecentSet(known_size)
+
+            # how many tweets up a thread to follow from a streamed tweet
+            self.max_thread_depth = 50
+            if self.conf.has_option("twitter", "maxThreadDepth"):
+                self.max_thread_depth = self.conf.getint("twitter",
+                                                         "maxThreadDepth")
+
+            # fingerprints of recent tweets, so that copy-paste campaigns
+            # are linked to the first copy rather than stored in full
+            self.dedup = create_dedup_index(self.conf)
+
+            # local full-text index of recorded tweets (None if unused)
+            self.search_index = create_search_index(self.conf)
+
+            # pool of threads writing to the graph (shared by everything
+            # writing to the same graph)
+            self.writer = create_graph_writer(self.conf, self.graph)
+
+            # deletions are applied to the graph in batches, in the
+            # background
+            self.deletes = DeleteBuffer(self.conf,
+                                        self.tombstones,
+                                        self.graph,
+                                        self.writer,
+                                        self.search_index)
+
             self.thread_queue = Queue(maxsize=0)
-            thread_thread = Thread(target=self.get_thread)
+            thread_thread = Thread(target=self.get_thread, daemon=True)
             thread_thread.start()
 
-            self.scraper = Scraper(self.conf, self.graph)
+            # share an existing scraper (and its threads) if one is provided
+            if scraper is None:
+                self.scraper = Scraper(self.conf, self.graph)
+            else:
+                self.scraper = scraper
+
+        # start recording once everything record_status uses is set up.
+        # Like the other workers, these threads are daemons, so that a
+        # script can exit once they are idle.
+        status_thread = Thread(target=self.record_status, daemon=True)
+        status_thread.start()
+
+    def load_blacklists(self):
+        """
+        Read the user and keyword blacklists, and build the notability model
+        and prefilter applying them
+        """
+        # blacklisted user IDs (NB: long numbers, stored as strings, rather
+        # than handles which change) and terms
+        user_blacklist, kw_blacklist = read_blacklists(self.conf, "twitter")
+
+        # model deciding which statuses to record, scoring micro-batches of
+        # up to batch_size statuses at a time
+        notability = create_tweet_model(self.conf,
+                                        user_blacklist,
+                                        kw_blacklist)
+        # the same rules, applied to raw stream data before parsing further
+        prefilter = TweetBlacklistModel(user_blacklist, kw_blacklist)
+
+        # replace the old ones in one go, as other threads are using them
+        (self.user_blacklist, self.kw_blacklist,
+         self.notability, self.prefilter) = (user_blacklist, kw_blacklist,
+                                             notability, prefilter)
 
     # see https://github.com/tweepy/tweepy/issues/908#issuecomment-373840687
+    @TRACER.trace("on_data")
     def on_data(self, raw_data):
         """
         This function overloads the on_data function in the tweepy package.
         It is called when raw data is received from tweepy connection.
+        Statuses take a fast path: retweets and blacklisted users and
+        keywords are dropped from the raw JSON, and survivors become compact
+        records without tweepy models being built. Other messages go to
+        tweepy's handling, except delete notices, which are frequent enough
+        to take a fast path too. Several streams may share one listener, so
+        tweets already seen on another stream are dropped.
         """
         # print("received data")
         try:
-            super().on_data(raw_data)
-            return True
-        except http_incompleteRead as error:
-            print("http.client Incomplete Read error: %s" % str(error))
-            print("Restarting stream search in 5 seconds...")
-            time.sleep(5)
+            data = json_loads(raw_data)
+            if "in_reply_to_status_id" in data:
+                if (self.seen_tweets.add(data["id"]) and
+                        self.prefilter.passes_raw(data)):
+                    self.on_status(StatusRecord.from_json(data))
+            elif "delete" in data:
+                status = data["delete"]["status"]
+                self.on_delete(status["id"], status["user_id"])
+            else:
+                super().on_data(raw_data)
             return True
-        except urllib3_incompleteRead as error:
-            print("urllib3 Incomplete Read error: %s" % str(error))
-            print("Restarting stream search in 5 seconds...")
-            time.sleep(5)
-            return True
-        except BaseException as error:
-            print("Error on_data: %s, Pausing..." % str(error))
-            time.sleep(5)
+        except Exception as error:
+            # never sleep here: a reader that falls behind is disconnected.
+            # Drop the message and carry on.
+            print("Error on_data: %s" % str(error))
             return True
 
+    @TRACER.trace("on_status")
     def on_status(self, status):
         """
         When a status is posted, sends it to a queue for recording.
-        Using a queue prevents back-ups from high volume.
+        Using a queue prevents back-ups from high volume. Only a compact
+        record of the fields we use is queued, not the whole tweepy Status.
 
         Args:
             status: a tweet with metadata
         """
         print("found tweet")
         try:
-            self.status_queue.put(status)
-        except BaseException as error:
-            print("Error on_status: %s, Pausing..." % str(error))
-            time.sleep(5)
+            self.status_queue.put(StatusRecord.from_status(status))
+        except Exception as error:
+            print("Error on_status: %s" % str(error))
         # print(str(len(self.status_queue.queue)) + " items in status_queue")
 
+    def on_record(self, record):
+        """
+        Take a status already parsed and prefiltered elsewhere (by a stream
+        process), dropping it if already seen on another stream
+        """
+        if self.seen_tweets.add(record.id):
+            self.on_status(record)
+        return True
+
     def on_error(self, status_code):
         """Print error codes as they occur"""
         print("Encountered error with status code:", status_code)
@@ -168,107 +287,196 @@ class MegatickStreamListener(tweepy.StreamListener):
         return True
 
     def on_delete(self, status_id, user_id):
-        """Note deleted tweets but do nothing else."""
-        print("Delete notice")
+        """Queue deleted tweets, to be applied in the next batch"""
+        self.deletes.put(status_id)
         return True
 
     def on_limit(self, track):
-        """Sleep and retry upon rate limit."""
-
-        # Print rate limiting error
-        print("Rate limited, waiting 15 minutes")
-
-        # Wait 15 minutes
-        time.sleep(15 * 60)
-
-        # Continue mining tweets
+        """
+        Note limit notices, which count the matching tweets not delivered
+        since connecting. The connection stays up, so there is nothing to
+        wait for.
+        """
+        print("Rate limited: %s undelivered tweets" % str(track))
         return True
 
     def on_timeout(self):
-        """Sleep and retry when timed out."""
-
-        # Print timeout message
-        print(sys.stderr, "Timeout...")
-
-        # Wait 10 seconds
-        time.sleep(10)
-
-        # Continue mining tweets
+        """Note timeouts; reconnecting is up to the stream (or supervisor)"""
+        print("Timeout...", file=sys.stderr)
         return True
 
+    def is_known(self, tweet_id):
+        """
+        True if a tweet with this ID is already in the graph, checking the
+        local index of recorded tweets before the graph itself.
+        """
+        if tweet_id in self.known_tweets:
+            return True
+        if get_tweet_node_by_id(self.graph, tweet_id) is not None:
+            self.known_tweets.add(tweet_id)
+            return True
+        return False
+
     def get_thread(self, show_rate_limit=None):
         """
         Given a Tweet object and its parent (either the tweet it's a
         quote-tweet of, or the tweet it's a reply to), find the parent (and
-        its parents, recursively) and link the tweet to its parent.
+        its parents, recursively) and link the tweet to its parent. Ascent
+        stops at a parent already in the graph, or at max_thread_depth.
         """
         # Time between requests to avoid overrunning rate limit
         if show_rate_limit is None:
             show_rate_limit = self.conf.getfloat("twitter", "showRateLimit")
 
         while True:
-            # get next tweet and parent ID from queue
-            later_status, earlier_id = self.thread_queue.get()
-
+            # get next tweet, parent ID and parent's depth from queue
+            later_status, earlier_id, depth = self.thread_queue.get()
             try:
-                # sleep first to respect rate limit
-                time.sleep(show_rate_limit)
-                # ask for status using GET statuses/show/:id
-                # TODO: batch these to get up to 100 using statuses/lookup
-                earlier_status = self.api.get_status(earlier_id)
-            except BaseException as error:
-                print("Error get_thread: %s, Pausing..." % str(error))
-                time.sleep(5)
-                # no available status at that ID (deleted or nonexistent)
-                self.thread_queue.task_done()
-                continue
-
-            # sanity check for content
-            if hasattr(earlier_status, "user"):
-                # record status
-                tweet_to_neo4j(self.graph, earlier_status)
-                # add link to graph to recreate Twitter threading
-                link_tweets(self.graph, later_status, earlier_status)
-                # recursive call to follow outgoing links
-                self.follow_links(earlier_status)
-
+                self.resolve_parent(later_status, earlier_id, depth,
+                                    show_rate_limit)
+            except Exception as error:
+                # keep following other threads
+                print("Error get_thread: %s" % str(error))
             self.thread_queue.task_done()
 
+    @TRACER.trace("get_thread")
+    def resolve_parent(self, later_status, earlier_id, depth,
+                       show_rate_limit):
+        """
+        Record the parent (by ID) of later_status and link them, queueing
+        the parent's own parents in turn.
+        """
+        if depth > self.max_thread_depth:
+            return
+
+        # parent already recorded, so link to it without asking the API
+        # and stop, since its own ancestors were followed when it was
+        if self.is_known(earlier_id):
+            self.writer.call(earlier_id,
+                             link_tweet_ids,
+                             self.graph,
+                             later_status.id,
+                             earlier_id)
+            return
+
+        try:
+            # sleep first to respect rate limit
+            time.sleep(show_rate_limit)
+            # ask for status using GET statuses/show/:id
+            # TODO: batch these to get up to 100 using statuses/lookup
+            earlier_status = self.api.get_status(earlier_id)
+        except BaseException as error:
+            print("Error get_thread: %s, Pausing..." % str(error))
+            time.sleep(5)
+            # no available status at that ID (deleted or nonexistent)
+            return
+
+        # sanity check for content
+        if hasattr(earlier_status, "user"):
+            earlier_status = StatusRecord.from_status(earlier_status)
+            # record status, unless deleted
+            written = self.writer.call(earlier_status.user.id,
+                                       self.deletes.write_live,
+                                       earlier_status.id,
+                                       tweet_to_neo4j,
+                                       self.graph,
+                                       earlier_status,
+                                       search_index=self.search_index)
+            if written is None:
+                return
+            self.known_tweets.add(earlier_status.id)
+            # add link to graph to recreate Twitter threading
+            self.writer.call(earlier_status.id,
+                             link_tweets,
+                             self.graph,
+                             later_status,
+                             earlier_status)
+            # recursive call to follow outgoing links
+            self.follow_links(earlier_status, depth=depth)
+
     def record_status(self):
         """
-        Pulls a status from the queue and records it.
+        Pulls statuses from the queue in micro-batches, scores them for
+        notability together, and records the notable ones.
         """
         while True:
-            status = self.status_queue.get()
-
-            notable = tweet_is_notable(status,
-                                       user_blacklist=self.user_blacklist,
-                                       kw_blacklist=self.kw_blacklist)
-            # check for notability, currently hardcoded as English and not RT
-            # TODO: make this modular to allow ML/ruley models of notability
-            if not notable:
-                # print("not notable, language=" + status.lang + " " + status.text)
-                continue
+            statuses = drain_queue(self.status_queue, self.batch_size)
 
-            # print("writing " + str(status.id))
+            # check for notability (by default, the blacklist rules)
+            with TRACER.span("notability"):
+                scores = self.notability.score_batch(statuses)
 
-            # If no Neo4j graph, write to csv
-            if self.graph is None:
+            for status, score in zip(statuses, scores):
                 try:
-                    # print("trying to write " + str(status.id) + " to csv")
-                    self.write_status_to_csv(status)
+                    with TRACER.span("record_status"):
+                        written = self.record_one(status, score)
                 except Exception as error:
-                    print(error)
+                    print("Error record_status: %s" % str(error))
+                    written = None
+                # in case we need side effects for finishing a task, mark
+                # complete (once written, if written by the graph writers)
+                if written is None:
+                    self.status_queue.task_done()
+                else:
+                    written.add_done_callback(
+                        lambda _: self.status_queue.task_done())
+
+    def record_one(self, status, score):
+        """
+        Record a single scored status, if it is notable. Writes to the graph
+        are handed to the graph writers, and a Future of the write is
+        returned (otherwise None).
+        """
+        if score < self.notability.threshold:
+            # print("not notable, language=" + status.lang + " " + status.text)
+            return None
 
-            # Neo4j graph is available, so write to it
-            else:
-                # add tweet to Neo4j graph
-                tweet_to_neo4j(self.graph, status)
-                # recursive call to follow outgoing links
-                self.follow_links(status)
+        # deleted before we got to it
+        if status.id in self.tombstones:
+            return None
 
-            # in case we need side effects for finishing a task, mark complete
-            self.status_queue.task_done()
+        # print("writing " + str(status.id))
+
+        # If no Neo4j graph, write to csv
+        if self.graph is None:
+            try:
+                # print("trying to write " + str(status.id) + " to csv")
+                self.write_status_to_csv(status)
+            except Exception as error:
+                print(error)
+
+        # Neo4j graph is available, so write to it
+        else:
+            # add tweet to Neo4j graph, linking near-duplicates to the
+            # earlier tweet they copy
+            full_text = get_full_text(status)
+            duplicate_of = None
+            if self.dedup is not None:
+                duplicate_of = self.dedup.check(status.id, full_text)
+            # writes for the same user go to the same writer, so that they
+            # never contend for the user's node (and are skipped if the
+            # tweet is deleted before they run)
+            written = self.writer.submit(status.user.id,
+                                         self.deletes.write_live,
+                                         status.id,
+                                         tweet_to_neo4j,
+                                         self.graph,
+                                         status,
+                                         full_text,
+                                         notability=float(score),
+                                         duplicate_of=duplicate_of,
+                                         search_index=self.search_index)
+            written.add_done_callback(
+                lambda future: self.tweet_written(status, future))
+            return written
+        return None
+
+    def tweet_written(self, status, future):
+        """Once a status is in the graph, follow its links"""
+        if future.exception() is None and future.result() is not None:
+            self.known_tweets.add(status.id)
+            # recursive call to follow outgoing links
+            self.follow_links(status)
 
     def write_status_to_csv(self, status):
         """Write a status in flat format (not following links)"""
@@ -308,13 +516,11 @@ class MegatickStreamListener(tweepy.StreamListener):
                                   status.favorited,
                                   status.retweet_count])
 
-        # flush to force writing
-        self.csv_file.flush()
-
-    def follow_links(self, status, urls=None):
+    def follow_links(self, status, urls=None, depth=0):
         """
         Follow (quote, reply, external) links and add them to queues. This
-        is accomplished through threads to avoid blocking up stream.filter
+        is accomplished through threads to avoid blocking up stream.filter.
+        depth is how far up a thread status is from the streamed tweet.
         """
         if urls is None:
             urls = get_urls(status)
@@ -326,9 +532,9 @@ class MegatickStreamListener(tweepy.StreamListener):
         if status.is_quote_status:
             # add upstream quote-tweet thread to download pipe
             prev_id = status.quoted_status_id
-            self.thread_queue.put((status, prev_id))
+            self.thread_queue.put((status, prev_id, depth + 1))
 
         if status.in_reply_to_status_id is not None:
             # add upstream tweet reply thread to download pipe
             prev_id = status.in_reply_to_status_id
-            self.thread_queue.put((status, prev_id))
+            self.thread_queue.put((status, prev_id, depth + 1))
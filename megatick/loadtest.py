@@ -0,0 +1,313 @@
+"""
+End-to-end load test with local stand-ins for Twitter (a streaming endpoint
+emitting tweets at a fixed rate), websites (articles served with a chosen
+latency and size) and the graph (an embedded graph that records when things
+are written). Reports the throughput a configuration sustains, how queues
+grow, and end-to-end latency.
+"""
+
+import configparser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import tempfile
+import time
+from threading import Lock, Thread
+
+import requests
+import tweepy
+
+from megatick.embedded import EmbeddedGraph
+from megatick.listeners import MegatickStreamListener
+from megatick.tracing import TRACER, install_hooks
+
+WORDS = ("breach patch exploit vulnerability ransomware phishing botnet "
+         "malware firewall zero day disclosure advisory researchers report "
+         "attack server password leak update critical severity vendor").split()
+
+def fake_tweet(tweet_id, site, num_pages):
+    """A tweet, as JSON from the streaming API, linking to a fake article"""
+    now = time.time()
+    created_at = time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime(now))
+    user_id = random.randrange(1, 10000)
+    page = random.randrange(num_pages)
+    return {"id": tweet_id,
+            "id_str": str(tweet_id),
+            "text": "megatick " + " ".join(random.choices(WORDS, k=16)),
+            "created_at": created_at,
+            "timestamp_ms": str(int(now * 1000)),
+            "geo": None,
+            "coordinates": None,
+            "place": None,
+            "lang": "en",
+            "source": "megatick load test",
+            "favorite_count": 0,
+            "retweet_count": 0,
+            "favorited": False,
+            "retweeted": False,
+            "is_quote_status": False,
+            "in_reply_to_status_id": None,
+            "entities": {"urls": [{"expanded_url":
+                                   "%s/article/%d" % (site, page)}]},
+            "user": {"id": user_id,
+                     "id_str": str(user_id),
+                     "screen_name": "user%d" % user_id,
+                     "name": "User %d" % user_id,
+                     "created_at": created_at,
+                     "url": None,
+                     "favourites_count": 0,
+                     "statuses_count": 1,
+                     "description": "",
+                     "location": "",
+                     "verified": False,
+                     "following": None,
+                     "listed_count": 0,
+                     "followers_count": 0,
+                     "default_profile_image": False,
+                     "utc_offset": None,
+                     "friends_count": 0,
+                     "default_profile": True,
+                     "lang": None,
+                     "geo_enabled": False,
+                     "time_zone": None}}
+
+class FakeTwitter(ThreadingHTTPServer):
+    """Local streaming endpoint emitting tweets at a fixed rate"""
+    daemon_threads = True
+
+    def __init__(self, rate, site, num_pages):
+        super().__init__(("127.0.0.1", 0), FakeTwitterHandler)
+        self.rate = rate
+        self.site = site
+        self.num_pages = num_pages
+        self.running = True
+        self.next_id = 1
+        # tweet ID -> time it was emitted, url -> time it was first cited
+        self.emitted = {}
+        self.cited = {}
+        self.lock = Lock()
+
+    def next_tweet(self):
+        """Build the next tweet and note when it was emitted"""
+        with self.lock:
+            tweet_id = self.next_id
+            self.next_id += 1
+            self.emitted[tweet_id] = time.time()
+        tweet = fake_tweet(tweet_id, self.site, self.num_pages)
+        for url in tweet["entities"]["urls"]:
+            self.cited.setdefault(url["expanded_url"], self.emitted[tweet_id])
+        return tweet
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    """Serves a length-delimited filter stream, as Twitter does"""
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.end_headers()
+        interval = 1.0 / self.server.rate
+        next_time = time.monotonic()
+        try:
+            while self.server.running:
+                payload = (json.dumps(self.server.next_tweet()) +
+                           "\r\n").encode("utf-8")
+                self.wfile.write(b"%d\r\n%s" % (len(payload), payload))
+                self.wfile.flush()
+                next_time += interval
+                time.sleep(max(0.0, next_time - time.monotonic()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class FakeSites(ThreadingHTTPServer):
+    """Local web server serving generated articles"""
+    daemon_threads = True
+
+    def __init__(self, latency, size):
+        super().__init__(("127.0.0.1", 0), FakeSitesHandler)
+        self.latency = latency
+        self.size = size
+
+class FakeSitesHandler(BaseHTTPRequestHandler):
+    """Serves an article of the configured size after the set latency"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        words = " ".join(random.choices(WORDS, k=self.server.size // 8))
+        body = ("<html><body><h1>%s</h1><p>%s</p></body></html>" %
+                (self.path, words)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class RecordingGraph(EmbeddedGraph):
+    """Embedded graph noting when each tweet and page is first written"""
+    def __init__(self, location):
+        super().__init__(location)
+        self.written = {"Tweet": {}, "WebPage": {}}
+
+    def merge_node(self, node, label=None, key_name=None):
+        created = super().merge_node(node, label, key_name)
+        times = self.written.get(node.__primarylabel__)
+        if created and times is not None:
+            times[node[node.__primarykey__]] = time.time()
+        return created
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """Sends https requests for a host to a local plain-http server"""
+    def __init__(self, host, local):
+        super().__init__()
+        self.prefix = "https://" + host
+        self.local = local
+
+    def send(self, request, **kwargs):
+        request.url = self.local + request.url[len(self.prefix):]
+        return super().send(request, **kwargs)
+
+class LocalStream(tweepy.Stream):
+    """A tweepy Stream reading from a local fake streaming endpoint"""
+    def __init__(self, auth, listener, local, **options):
+        # new_session is called before tweepy sets host, so set it first
+        self.host = options.get("host", "stream.twitter.com")
+        self.local = local
+        super().__init__(auth, listener, **options)
+
+    def new_session(self):
+        super().new_session()
+        self.session.mount("https://" + self.host,
+                           LocalAdapter(self.host, self.local))
+
+def percentiles(values, points=(50, 95, 99)):
+    """The given percentiles of values (None if there are none)"""
+    if not values:
+        return {point: None for point in points}
+    values = sorted(values)
+    return {point: values[min(len(values) - 1, len(values) * point // 100)]
+            for point in points}
+
+class LoadTest:
+    """Run the listener and scraper against local stand-ins and measure"""
+    def __init__(self, conf=None):
+        # load default conf if none is provided
+        if conf is None:
+            # load default configuration
+            conf = configparser.ConfigParser()
+            conf.read("config.ini")
+
+        def option(name, default, get):
+            if conf.has_option("loadtest", name):
+                return get("loadtest", name)
+            return default
+
+        self.rate = option("rate", 50.0, conf.getfloat)
+        self.duration = option("duration", 60.0, conf.getfloat)
+        self.page_latency = option("pageLatency", 0.2, conf.getfloat)
+        self.page_size = option("pageSize", 20000, conf.getint)
+        self.num_pages = option("numPages", 1000, conf.getint)
+
+        self.workdir = tempfile.mkdtemp(prefix="megatick-loadtest-")
+
+        # the configuration under test, with its local files moved to a
+        # scratch directory
+        self.conf = configparser.ConfigParser()
+        self.conf.read_dict({section: dict(conf.items(section, raw=True))
+                             for section in conf.sections()})
+        self.conf.read_dict({"DEFAULT": dict(conf.items("DEFAULT",
+                                                        raw=True))})
+        self.conf.set("DEFAULT", "urlCacheLoc",
+                      os.path.join(self.workdir, "url_cache.sqlite"))
+        if self.conf.has_option("DEFAULT", "searchIndexLoc"):
+            self.conf.set("DEFAULT", "searchIndexLoc",
+                          os.path.join(self.workdir, "search.sqlite"))
+        if not self.conf.has_option("DEFAULT", "numUrlThreads"):
+            self.conf.set("DEFAULT", "numUrlThreads", "8")
+        if not self.conf.has_section("twitter"):
+            self.conf.add_section("twitter")
+        if not self.conf.has_option("twitter", "showRateLimit"):
+            self.conf.set("twitter", "showRateLimit", "1")
+        # every article is served from the one local host, so per-host
+        # politeness would measure nothing but itself
+        self.conf.set("DEFAULT", "hostDelay", "0")
+        self.conf.set("DEFAULT", "hostConcurrency",
+                      self.conf.get("DEFAULT", "numUrlThreads"))
+
+    def run(self):
+        """Run the load test for the configured duration and report"""
+        sites = FakeSites(self.page_latency, self.page_size)
+        site = "http://127.0.0.1:%d" % sites.server_address[1]
+        twitter = FakeTwitter(self.rate, site, self.num_pages)
+        local = "http://127.0.0.1:%d" % twitter.server_address[1]
+        for server in (sites, twitter):
+            Thread(target=server.serve_forever, daemon=True).start()
+
+        install_hooks(self.conf)
+        graph = RecordingGraph(os.path.join(self.workdir, "graph.sqlite"))
+        auth = tweepy.OAuthHandler("loadtest", "loadtest")
+        auth.set_access_token("loadtest", "loadtest")
+        api = tweepy.API(auth)
+        listener = MegatickStreamListener(api=api, graph=graph, conf=self.conf)
+        stream = LocalStream(auth, listener, local)
+
+        print("Load test: %.1f tweets/s for %.0f s" % (self.rate,
+                                                      self.duration))
+        start = time.time()
+        stream.filter(track=["megatick"], is_async=True)
+
+        samples = []
+        while time.time() - start < self.duration:
+            time.sleep(1)
+            samples.append((time.time() - start,
+                            len(twitter.emitted),
+                            len(graph.written["Tweet"]),
+                            listener.status_queue.qsize(),
+                            listener.scraper.queue.qsize() +
+                            listener.scraper.scheduler.qsize(),
+                            len(graph.written["WebPage"])))
+            print("%6.1f s  emitted %7d  recorded %7d  status_queue %6d  "
+                  "url_queue %6d  pages %6d" % samples[-1])
+
+        twitter.running = False
+        stream.disconnect()
+        elapsed = time.time() - start
+        return self.report(samples, twitter, graph.written, elapsed)
+
+    def report(self, samples, twitter, written, elapsed):
+        """Summarize throughput, queue growth and latency"""
+        emitted = twitter.emitted
+        tweet_latency = [written["Tweet"][tweet_id] - emitted[tweet_id]
+                         for tweet_id in written["Tweet"]
+                         if tweet_id in emitted]
+        page_latency = [written["WebPage"][url] - twitter.cited[url]
+                        for url in written["WebPage"]
+                        if url in twitter.cited]
+        half = samples[len(samples) // 2:]
+        if len(half) > 1:
+            span = half[-1][0] - half[0][0]
+            growth = (half[-1][3] - half[0][3]) / span
+            url_growth = (half[-1][4] - half[0][4]) / span
+        else:
+            growth = url_growth = 0.0
+        result = {"emitted_per_s": len(emitted) / elapsed,
+                  "recorded_per_s": len(written["Tweet"]) / elapsed,
+                  "pages_per_s": len(written["WebPage"]) / elapsed,
+                  "status_queue_growth_per_s": growth,
+                  "url_queue_growth_per_s": url_growth,
+                  "tweet_latency_s": percentiles(tweet_latency),
+                  "page_latency_s": percentiles(page_latency),
+                  "stages": TRACER.stats(elapsed)}
+        print(json.dumps(result, indent=2))
+        # the rate is sustainable if queues are not growing
+        if growth > 0.05 * self.rate:
+            print("NOT sustained: status queue grows %.1f/s" % growth)
+        elif url_growth > 0.05 * self.rate:
+            print("NOT sustained: url queue grows %.1f/s" % url_growth)
+        else:
+            print("Sustained %.1f tweets/s" % result["recorded_per_s"])
+        return result
@@ -15,10 +15,20 @@ from bs4 import BeautifulSoup as bs
 import schedule
 import tweepy
 
-from megatick.database import reddit_to_neo4j
-from megatick.utils import create_graph, create_twitter_auth, create_reddit_auth, reddit_is_notable
+from megatick.backfill import Backfill
+from megatick.database import (comments_to_neo4j, get_reddit_submission_node,
+                               reddit_to_neo4j)
+from megatick.utils import (RecentSet, create_graph, create_twitter_auth,
+                            create_reddit_auth, drain_queue, find_urls,
+                            read_blacklists, read_lines, watch_files)
 from megatick.listeners import MegatickStreamListener
+from megatick.notability import (RedditCommentBlacklistModel,
+                                 create_reddit_model)
 from megatick.scraper import Scraper
+from megatick.search import create_search_index
+from megatick.shards import ShardedStream, partition_filters
+from megatick.tracing import install_hooks
+from megatick.writer import create_graph_writer
 
 class Monitor(ABC):
     """A Monitor reads some sites/api and records the results"""
@@ -31,7 +41,7 @@ class Monitor(ABC):
 
 class TwitterMonitor(Monitor):
     """Monitor a pre-determined set of users and keywords on Twitter."""
-    def __init__(self, conf=None):
+    def __init__(self, conf=None, graph=None, scraper=None):
         """Initialization"""
         # load default conf if none is provided
         if conf is None:
@@ -47,27 +57,50 @@ class TwitterMonitor(Monitor):
         else:
             self.languages = None
 
-        # what keywords to follow
-        # TODO: keywords should be updated by an explorer module
-        self.keywords = []
-        with open(self.conf.get("twitter", "keywordsLoc"), "r") as kw_file:
-            self.keywords = [line.strip() for line in kw_file]
-
-        # what users to follow
-        # TODO: users should be updated by an explorer module
-        self.users = []
-        with open(self.conf.get("twitter", "usersLoc"), "r") as user_file:
-            self.users = [line.strip() for line in user_file]
-
-        # create Neo4j Graph object if necessary
-        if self.conf.getboolean("neo4j", "useNeo4j"):
+        # what keywords and users to follow (reloaded when the files change)
+        # TODO: keywords and users should be updated by an explorer module
+        self.keywords = read_lines(self.conf.get("twitter", "keywordsLoc"))
+        self.users = read_lines(self.conf.get("twitter", "usersLoc"))
+
+        # how many stream connections to split keywords and users across
+        # (more are used if needed to stay within per-connection limits),
+        # and whether to read each in its own process
+        self.num_streams = 1
+        if self.conf.has_option("twitter", "numStreams"):
+            self.num_streams = self.conf.getint("twitter", "numStreams")
+        self.stream_processes = False
+        if self.conf.has_option("twitter", "streamProcesses"):
+            self.stream_processes = self.conf.getboolean("twitter",
+                                                         "streamProcesses")
+        # how long new connections have to go live before replacing old ones
+        self.swap_timeout = 60.0
+        if self.conf.has_option("twitter", "swapTimeout"):
+            self.swap_timeout = self.conf.getfloat("twitter", "swapTimeout")
+        self.stream = None
+
+        # whether to backfill recent tweets for keywords and users as they
+        # are added, alongside the stream
+        self.use_backfill = False
+        if self.conf.has_option("twitter", "backfill"):
+            self.use_backfill = self.conf.getboolean("twitter", "backfill")
+        self.backfill = None
+
+        # create Neo4j Graph object if necessary (or share the one provided)
+        if graph is not None:
+            self.graph = graph
+        elif self.conf.getboolean("neo4j", "useNeo4j"):
             print("Attempting to load graph")
             self.graph = create_graph(self.conf)
         else:
             self.graph = None
 
-        # initialize scraper for external links
-        self.scraper = Scraper(self.conf, self.graph)
+        # initialize scraper for external links (only used with a graph)
+        if scraper is not None:
+            self.scraper = scraper
+        elif self.graph is not None:
+            self.scraper = Scraper(self.conf, self.graph)
+        else:
+            self.scraper = None
 
         # authorize our API
         auth = create_twitter_auth(self.conf)
@@ -79,20 +112,53 @@ class TwitterMonitor(Monitor):
 
     def start(self):
         """Start up TwitterMonitor (through MegatickStreamListener)"""
+        install_hooks(self.conf)
+
         # access keyword stream for selected keyword(s)
         stream_listener = MegatickStreamListener(api=self.api,
-                                                 graph=self.graph)
-        stream = tweepy.Stream(auth=self.api.auth,
-                               listener=stream_listener)
-
-        # get up to 1% of Twitter stream this way (~60 tweets/s)
-        stream.filter(track=self.keywords,
-                      follow=self.users,
-                      languages=self.languages)
+                                                 graph=self.graph,
+                                                 conf=self.conf,
+                                                 scraper=self.scraper)
+        self.stream = ShardedStream(self.conf,
+                                    stream_listener,
+                                    languages=self.languages,
+                                    processes=self.stream_processes,
+                                    swap_timeout=self.swap_timeout)
+
+        # pagers run in their own threads, so this doesn't hold up the stream
+        if self.use_backfill:
+            self.backfill = Backfill(self.conf, stream_listener)
+            self.backfill.add(self.keywords, self.users)
+
+        # when the keyword or user list changes, swap to new connections
+        watch_files(self.conf,
+                    [self.conf.get("twitter", "keywordsLoc"),
+                     self.conf.get("twitter", "usersLoc")],
+                    self.reload_filters)
+
+        # get up to 1% of Twitter stream per connection (~60 tweets/s)
+        self.stream.run(partition_filters(self.keywords,
+                                          self.users,
+                                          self.num_streams))
+
+    def reload_filters(self):
+        """Re-read keywords and users, and stream with them instead"""
+        keywords = read_lines(self.conf.get("twitter", "keywordsLoc"))
+        users = read_lines(self.conf.get("twitter", "usersLoc"))
+        if keywords == self.keywords and users == self.users:
+            return
+        print("Reloading keywords and users")
+        if self.stream.swap(partition_filters(keywords,
+                                              users,
+                                              self.num_streams)):
+            self.keywords = keywords
+            self.users = users
+            if self.backfill is not None:
+                self.backfill.add(keywords, users)
 
 class RedditMonitor(Monitor):
     """Monitor a pre-determined set of subreddits"""
-    def __init__(self, conf=None):
+    def __init__(self, conf=None, graph=None, scraper=None):
         """Initialization"""
         # load default conf if none is provided
         if conf is None:
@@ -102,95 +168,328 @@ class RedditMonitor(Monitor):
         else:
             self.conf = conf
 
-        # what subreddits to follow
+        # what subreddits to follow (reloaded when the file changes)
         # TODO: subreddits should be updated by an explorer module
-        self.subreddits = ""
-        with open(self.conf.get("reddit", "subredditsLoc"), "r") as sr_file:
-            lines = [line.strip() for line in sr_file]
-            self.subreddits = "+".join(lines)
+        self.subreddits = "+".join(
+            read_lines(self.conf.get("reddit", "subredditsLoc")))
 
-        # create Neo4j Graph object if necessary
-        if self.conf.getboolean("neo4j", "useNeo4j"):
+        # create Neo4j Graph object if necessary (or share the one provided)
+        if graph is not None:
+            self.graph = graph
+        elif self.conf.getboolean("neo4j", "useNeo4j"):
             print("Attempting to load graph")
             self.graph = create_graph(self.conf)
         else:
             self.graph = None
 
-        # read list of blacklisted user IDs to filter out.
-        self.user_blacklist = None
-        if self.conf.has_option("reddit", "userBlacklistLoc"):
-            user_blacklist_loc = self.conf.get("reddit", "userBlacklistLoc")
-            with open(user_blacklist_loc, "r") as bl_file:
-                self.user_blacklist = [line.strip() for line in bl_file]
+        # blacklists, and the model applying them, reloaded whenever the
+        # blacklist files change
+        self.load_blacklists()
+        watch_files(self.conf,
+                    [self.conf.get("reddit", "userBlacklistLoc",
+                                   fallback=None),
+                     self.conf.get("reddit", "keywordBlacklistLoc",
+                                   fallback=None)],
+                    self.load_blacklists)
+
+        # submissions are scored for notability in micro-batches of up to
+        # batch_size submissions at a time
+        self.batch_size = 100
+        if self.conf.has_option("reddit", "batchSize"):
+            self.batch_size = self.conf.getint("reddit", "batchSize")
+
+        # initialize scraper for external links (or share the one provided)
+        if scraper is not None:
+            self.scraper = scraper
+        else:
+            self.scraper = Scraper(self.conf, self.graph)
 
-        # read list of blacklisted terms and join them using | (or) for regex
-        # searches
-        self.kw_blacklist = None
-        if self.conf.has_option("reddit", "keywordBlacklistLoc"):
-            kw_blacklist_loc = self.conf.get("reddit", "keywordBlacklistLoc")
-            with open(kw_blacklist_loc, "r") as bl_file:
-                pieces = [line.strip() for line in bl_file]
-                self.kw_blacklist = "|".join(pieces)
+        # local full-text index of recorded submissions (None if unused)
+        self.search_index = create_search_index(self.conf)
 
-        self.scraper = Scraper(self.conf, self.graph)
+        # pool of threads writing to the graph (shared with the scraper)
+        self.writer = None
+        if self.graph is not None:
+            self.writer = create_graph_writer(self.conf, self.graph)
 
         # authorize our API
         self.reddit = create_reddit_auth(self.conf)
 
+        # IDs of recently streamed submissions, as a new stream starts with
+        # submissions the old one may already have passed on
+        seen_size = 10000
+        if self.conf.has_option("reddit", "seenSubmissionsSize"):
+            seen_size = self.conf.getint("reddit", "seenSubmissionsSize")
+        self.seen_submissions = RecentSet(seen_size)
+
+        # IDs of submissions recorded in the graph, or found not notable, so
+        # that comments on them need no lookups
+        self.known_submissions = RecentSet(seen_size)
+        self.skipped_submissions = RecentSet(seen_size)
+
         # set up queue to keep up with submission rate
         self.submission_queue = Queue(maxsize=0)
         thread = Thread(target=self.record_submission)
         thread.start()
 
+        # comments are followed alongside submissions (if there is a graph
+        # to record them in), and recorded in micro-batches of up to
+        # comment_batch_size comments by num_comment_threads threads
+        self.follow_comments = self.graph is not None
+        if self.conf.has_option("reddit", "followComments"):
+            self.follow_comments = (self.follow_comments and
+                                    self.conf.getboolean("reddit",
+                                                         "followComments"))
+        self.comment_batch_size = 100
+        if self.conf.has_option("reddit", "commentBatchSize"):
+            self.comment_batch_size = self.conf.getint("reddit",
+                                                       "commentBatchSize")
+        seen_comments_size = 100000
+        if self.conf.has_option("reddit", "seenCommentsSize"):
+            seen_comments_size = self.conf.getint("reddit",
+                                                  "seenCommentsSize")
+        self.seen_comments = RecentSet(seen_comments_size)
+        # fullnames of comment authors already recorded, whose details need
+        # not be looked up again
+        self.known_redditors = RecentSet(seen_comments_size)
+
+        self.comment_queue = Queue(maxsize=0)
+        if self.follow_comments:
+            num_comment_threads = 2
+            if self.conf.has_option("reddit", "numCommentThreads"):
+                num_comment_threads = self.conf.getint("reddit",
+                                                       "numCommentThreads")
+            for _ in range(num_comment_threads):
+                thread = Thread(target=self.record_comments)
+                thread.start()
+
+    def load_blacklists(self):
+        """
+        Read the user and keyword blacklists, and build the notability model
+        applying them
+        """
+        # blacklisted user names and terms
+        user_blacklist, kw_blacklist = read_blacklists(self.conf, "reddit")
+
+        # model deciding which submissions to record
+        notability = create_reddit_model(self.conf,
+                                         user_blacklist,
+                                         kw_blacklist)
+        # the blacklists, applied to comments
+        comment_prefilter = RedditCommentBlacklistModel(user_blacklist,
+                                                        kw_blacklist)
+
+        # replace the old ones in one go, as other threads are using them
+        (self.user_blacklist, self.kw_blacklist,
+         self.notability, self.comment_prefilter) = (user_blacklist,
+                                                     kw_blacklist,
+                                                     notability,
+                                                     comment_prefilter)
+
+    def reload_subreddits(self):
+        """
+        Re-read the subreddits; the stream is restarted with them once the
+        current request finishes
+        """
+        self.subreddits = "+".join(
+            read_lines(self.conf.get("reddit", "subredditsLoc")))
+
     def start(self):
         """Start monitoring"""
-        print("Monitoring: " + self.subreddits)
-        self.reddit_thread = Thread(target=self.record_submission)
+        install_hooks(self.conf)
+        watch_files(self.conf,
+                    [self.conf.get("reddit", "subredditsLoc")],
+                    self.reload_subreddits)
 
-        stream = self.reddit.subreddit(self.subreddits).stream
-        for submission in stream.submissions():
-            self.submission_queue.put(submission)
+        while True:
+            subreddits = self.subreddits
+            print("Monitoring: " + subreddits)
+
+            # pause_after=0 yields None once a request brings nothing new,
+            # so that the submission and comment streams take turns, and a
+            # change of subreddits is noticed even on quiet streams. praw
+            # doesn't wait before its next request after yielding None, so
+            # when a whole round brings nothing new, wait here instead,
+            # doubling the wait (up to 16 s, as praw would) while nothing
+            # comes. New streams start with the latest submissions and
+            # comments, covering the swap.
+            stream = self.reddit.subreddit(subreddits).stream
+            streams = [(stream.submissions(pause_after=0),
+                        self.seen_submissions,
+                        self.submission_queue)]
+            if self.follow_comments:
+                streams.append((stream.comments(pause_after=0),
+                                self.seen_comments,
+                                self.comment_queue))
+            delay = 1.0
+            while self.subreddits == subreddits:
+                found = False
+                for items, seen, queue in streams:
+                    # a busy stream may never run dry, so each takes a turn
+                    # of at most one listing's worth
+                    for count, item in enumerate(items, 1):
+                        if item is None:
+                            break
+                        found = True
+                        if seen.add(item.id):
+                            queue.put(item)
+                        if count == 100:
+                            break
+                if found:
+                    delay = 1.0
+                else:
+                    time.sleep(delay)
+                    delay = min(2 * delay, 16.0)
 
     def record_submission(self):
         """
-        Pulls a submission from the queue and records it.
+        Pulls submissions from the queue in micro-batches, scores them for
+        notability together, and records the notable ones.
+        """
+        while True:
+            submissions = drain_queue(self.submission_queue, self.batch_size)
+
+            # check for notability (by default, the blacklist rules)
+            scores = self.notability.score_batch(submissions)
+
+            for submission, score in zip(submissions, scores):
+                print("found " + submission.permalink)
+                try:
+                    self.record_one(submission, score)
+                except Exception as error:
+                    print("Error record_submission: %s" % str(error))
+
+                # in case we need side effects for finishing a task, mark
+                # complete
+                self.submission_queue.task_done()
+
+    def record_one(self, submission, score):
+        """Record a single scored submission, if it is notable"""
+        if score < self.notability.threshold:
+            self.skipped_submissions.add(submission.id)
+            return
+
+        # If no Neo4j graph, write to csv
+        # if self.graph is None:
+            # TODO: write reddit submission to csv
+            # try:
+            #     # print("trying to write " + str(submission.id) + " to csv")
+            #     self.write_reddit_to_csv(submission)
+            # except Exception as error:
+            #     print(error)
+        # Neo4j graph is available, so write to it
+        if self.graph is not None:
+        # else:
+            # print("recording " + submission.permalink)
+            # add tweet to Neo4j graph
+            # (writes by the same author go to the same writer)
+            _, submission_node, _ = self.writer.call(
+                str(submission.author),
+                reddit_to_neo4j,
+                self.graph,
+                submission,
+                notability=float(score),
+                search_index=self.search_index)
+            self.known_submissions.add(submission.id)
+            # recursive call to follow outgoing links
+            if submission.url != submission.permalink:
+                self.scraper.link(submission_node, [submission.url])
+
+    def is_recorded(self, submission_id):
+        """True if a submission with this ID is in the graph"""
+        if submission_id in self.known_submissions:
+            return True
+        if get_reddit_submission_node(self.graph, submission_id) is not None:
+            self.known_submissions.add(submission_id)
+            return True
+        return False
+
+    def record_comments(self):
+        """
+        Pulls comments from the queue in micro-batches and records them,
+        looking up what they need for the whole batch at once.
         """
         while True:
-            submission = self.submission_queue.get()
-
-            print("found " + submission.permalink)
-            notable = reddit_is_notable(submission,
-                                        user_blacklist=self.user_blacklist,
-                                        kw_blacklist=self.kw_blacklist)
-            # check for notability
-            # TODO: make this modular to allow ML/ruley models of notability
-            if not notable:
+            comments = drain_queue(self.comment_queue, self.comment_batch_size)
+            try:
+                self.record_comment_batch(comments)
+            except Exception as error:
+                # keep recording other batches
+                print("Error record_comments: %s" % str(error))
+            for _ in comments:
+                self.comment_queue.task_done()
+
+    def record_comment_batch(self, comments):
+        """
+        Record a micro-batch of comments passing the blacklists, on
+        submissions that are (or turn out to be) notable, along with their
+        authors, then follow their links
+        """
+        scores = self.comment_prefilter.score_batch(comments)
+        by_submission = {}
+        for comment, score in zip(comments, scores):
+            if score >= self.comment_prefilter.threshold:
+                # link_id is the submission's fullname (t3_...)
+                by_submission.setdefault(comment.link_id[3:],
+                                         []).append(comment)
+
+        # fetch the submissions not yet seen (up to 100 per request) and
+        # record them first, so that comments can be linked to them
+        missing = [submission_id for submission_id in by_submission
+                   if submission_id not in self.skipped_submissions and
+                   not self.is_recorded(submission_id)]
+        if missing:
+            submissions = list(self.reddit.info(
+                fullnames=["t3_" + submission_id
+                           for submission_id in missing]))
+            scores = self.notability.score_batch(submissions)
+            for submission, score in zip(submissions, scores):
+                self.seen_submissions.add(submission.id)
+                try:
+                    self.record_one(submission, score)
+                except Exception as error:
+                    print("Error record_comments: %s" % str(error))
+
+        # look up the details of new authors (up to 100 per request)
+        fullnames = {comment.author_fullname
+                     for group in by_submission.values() for comment in group
+                     if getattr(comment, "author_fullname", None) is not None
+                     and comment.author_fullname not in self.known_redditors}
+        authors = {}
+        if fullnames:
+            authors = {partial.fullname: partial for partial in
+                       self.reddit.redditors.partial_redditors(fullnames)}
+
+        # write the comments on each submission together, with comments on
+        # different submissions written in parallel
+        written = [(self.writer.submit(submission_id,
+                                       comments_to_neo4j,
+                                       self.graph,
+                                       submission_id,
+                                       group,
+                                       authors,
+                                       search_index=self.search_index),
+                    group)
+                   for submission_id, group in by_submission.items()
+                   if submission_id in self.known_submissions]
+        for future, group in written:
+            try:
+                nodes = future.result()
+            except Exception as error:
+                print("Error record_comments: %s" % str(error))
                 continue
-
-            # If no Neo4j graph, write to csv
-            # if self.graph is None:
-                # TODO: write reddit submission to csv
-                # try:
-                #     # print("trying to write " + str(submission.id) + " to csv")
-                #     self.write_reddit_to_csv(submission)
-                # except Exception as error:
-                #     print(error)
-            # Neo4j graph is available, so write to it
-            if self.graph is not None:
-            # else:
-                # print("recording " + submission.permalink)
-                # add tweet to Neo4j graph
-                _, submission_node, _ = reddit_to_neo4j(self.graph, submission)
-                # recursive call to follow outgoing links
-                if submission.url != submission.permalink:
-                    self.scraper.link(submission_node, [submission.url])
-
-            # in case we need side effects for finishing a task, mark complete
-            self.submission_queue.task_done()
+            for comment, node in zip(group, nodes):
+                fullname = getattr(comment, "author_fullname", None)
+                if fullname in authors:
+                    self.known_redditors.add(fullname)
+                # follow links in the comment's text
+                urls = find_urls(comment.body)
+                if urls:
+                    self.scraper.link(node, urls)
 
 class RssMonitor(Monitor):
     """Monitor a pre-determined set of users and keywords on Twitter."""
-    def __init__(self, conf=None):
+    def __init__(self, conf=None, graph=None, scraper=None):
         """Initialization"""
         # load default conf if none is provided
         if conf is None:
@@ -207,15 +506,20 @@ class RssMonitor(Monitor):
         with open(self.conf.get("rss", "feedsLoc"), "r") as feed_file:
             self.feeds = [line.strip() for line in feed_file]
 
-        # create Neo4j Graph object if necessary
-        if self.conf.getboolean("neo4j", "useNeo4j"):
+        # create Neo4j Graph object if necessary (or share the one provided)
+        if graph is not None:
+            self.graph = graph
+        elif self.conf.getboolean("neo4j", "useNeo4j"):
             print("Attempting to load graph")
             self.graph = create_graph(self.conf)
         else:
             self.graph = None
 
-        # initialize scraper for external links
-        self.scraper = Scraper(self.conf, self.graph)
+        # initialize scraper for external links (or share the one provided)
+        if scraper is not None:
+            self.scraper = scraper
+        else:
+            self.scraper = Scraper(self.conf, self.graph)
 
     def check_rss(self):
         """Read RSS feeds and add their item links to the scraper queue"""
@@ -240,6 +544,8 @@ class RssMonitor(Monitor):
 
     def start(self):
         """Start monitoring RSS feeds periodically"""
+        install_hooks(self.conf)
+
         # schedule for one hour
         # TODO: make scheduling configurable
         schedule.every().hour.do(self.check_rss)
@@ -38,7 +38,8 @@ class RedditSubmission(Node):
                  text,
                  subreddit,
                  title,
-                 upvote_ratio):
+                 upvote_ratio,
+                 notability=None):
         super().__init__("RedditSubmission",
                          created_at=created_at,
                          submission_id=submission_id,
@@ -47,7 +48,8 @@ class RedditSubmission(Node):
                          text=text,
                          subreddit=subreddit,
                          title=title,
-                         upvote_ratio=upvote_ratio)
+                         upvote_ratio=upvote_ratio,
+                         notability=notability)
     def add_to(self, graph):
         """
         Add this node to an existing graph, or update it if it already exists.
@@ -91,7 +93,8 @@ class Tweet(Node):
                  retweeted,
                  source,
                  favorited,
-                 retweet_count):
+                 retweet_count,
+                 notability=None):
         super().__init__("Tweet",
                          tweet_id=tweet_id,
                          text=text,
@@ -103,7 +106,8 @@ class Tweet(Node):
                          retweeted=retweeted,
                          source=source,
                          favorited=favorited,
-                         retweet_count=retweet_count)
+                         retweet_count=retweet_count,
+                         notability=notability)
 
     def add_to(self, graph):
         """
@@ -163,16 +167,26 @@ class TwitterUser(Node):
         return graph.merge(self, "TwitterUser", "user_id")
 
 class WebPage(Node):
-    """WebPage with required parameters"""
+    """WebPage with required parameters, and HTTP validators if known"""
     def __init__(self,
                  url,
-                 content):
+                 content,
+                 fetched_at=None,
+                 etag=None,
+                 last_modified=None):
         super().__init__("WebPage",
                          url=url,
-                         content=content)
+                         content=content,
+                         fetched_at=fetched_at,
+                         etag=etag,
+                         last_modified=last_modified)
 
-    def add_to(self, graph):
+    def add_to(self, graph, search_index=None):
         """
         Add this node to an existing graph, or update it if it already exists.
+        If a search index is given, its content is indexed there too.
         """
-        return graph.merge(self, "WebPage", "url")
+        merged = graph.merge(self, "WebPage", "url")
+        if search_index is not None and self["content"] is not None:
+            search_index.add("WebPage", self["url"], None, self["content"])
+        return merged
@@ -0,0 +1,163 @@
+"""
+Pluggable models deciding which statuses and submissions are worth recording.
+Models score micro-batches: features for a whole batch are extracted into a
+NumPy array and scored in a single vectorized call.
+"""
+
+from abc import ABC, abstractmethod
+import re
+
+import numpy as np
+
+from megatick.records import raw_full_text
+from megatick.utils import get_full_text
+
+class NotabilityModel(ABC):
+    """Scores a batch of items; those scoring at least threshold are kept"""
+    threshold = 0.5
+
+    @abstractmethod
+    def features(self, items):
+        """Return features of items, e.g. an (n_items, n_features) array"""
+
+    @abstractmethod
+    def score(self, features):
+        """Return an (n_items,) array of scores in [0, 1] for features"""
+
+    def score_batch(self, items):
+        """Score a list of items in one call"""
+        if len(items) == 0:
+            return np.zeros(0)
+        return self.score(self.features(items))
+
+class BlacklistModel(NotabilityModel):
+    """
+    Rule-based model: an item scores 1 if it passes every rule (e.g. not
+    written by a blacklisted user, no blacklisted keywords), otherwise 0.
+    """
+    def __init__(self, user_blacklist=None, kw_blacklist=None):
+        self.user_blacklist = (None if user_blacklist is None
+                               else set(user_blacklist))
+        self.kw_blacklist = (None if kw_blacklist is None
+                             else re.compile(kw_blacklist))
+
+    @abstractmethod
+    def rules(self, item):
+        """Return a tuple of booleans, one per rule, True if item passes"""
+
+    def features(self, items):
+        return np.array([self.rules(item) for item in items], dtype=bool)
+
+    def score(self, features):
+        return features.all(axis=1).astype(float)
+
+class TweetBlacklistModel(BlacklistModel):
+    """The default rules for tweets"""
+    def rules(self, item):
+        full_text = get_full_text(item)
+        # we're not interested in RTs with no added info
+        non_rt = item.text[0:2] != 'RT'
+        user_ok = (self.user_blacklist is None or
+                   item.user.id_str not in self.user_blacklist)
+        text_ok = (self.kw_blacklist is None or
+                   self.kw_blacklist.search(full_text) is None)
+        return (non_rt, user_ok, text_ok)
+
+    def passes_raw(self, data):
+        """
+        Apply the same rules to a tweet's raw JSON (as a dict), so that
+        tweets can be dropped before any models are built for them
+        """
+        # (search and timeline results have only full_text, not text)
+        full_text = raw_full_text(data)
+        if full_text[0:2] == 'RT':
+            return False
+        if (self.user_blacklist is not None and
+                data["user"]["id_str"] in self.user_blacklist):
+            return False
+        return (self.kw_blacklist is None or
+                self.kw_blacklist.search(full_text) is None)
+
+class RedditBlacklistModel(BlacklistModel):
+    """The default rules for Reddit submissions"""
+    def rules(self, item):
+        user_ok = (self.user_blacklist is None or
+                   item.author.name not in self.user_blacklist)
+        text_ok = (self.kw_blacklist is None or
+                   self.kw_blacklist.search(item.selftext) is None)
+        return (user_ok, text_ok)
+
+class RedditCommentBlacklistModel(BlacklistModel):
+    """The same rules for Reddit comments, whose authors may be deleted"""
+    def rules(self, item):
+        user_ok = (self.user_blacklist is None or item.author is None or
+                   item.author.name not in self.user_blacklist)
+        text_ok = (self.kw_blacklist is None or
+                   self.kw_blacklist.search(item.body) is None)
+        return (user_ok, text_ok)
+
+class LinearTextModel(NotabilityModel):
+    """
+    Linear text classifier over hashed word n-grams, gated by rules (items
+    failing the rules score 0). Weights are read from a .npz file with a
+    "coef" array (one weight per hashed feature) and an "intercept".
+    """
+    def __init__(self, weights_loc, rules, text, threshold=0.5):
+        # scikit-learn is only needed for this model
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        weights = np.load(weights_loc)
+        self.coef = weights["coef"].ravel()
+        self.intercept = float(np.ravel(weights["intercept"])[0])
+        self.vectorizer = HashingVectorizer(n_features=len(self.coef),
+                                            ngram_range=(1, 2),
+                                            alternate_sign=False)
+        self.rules = rules
+        self.text = text
+        self.threshold = threshold
+
+    def features(self, items):
+        # sparse hashed n-gram counts, plus the rules' verdict for gating
+        hashed = self.vectorizer.transform([self.text(item)
+                                            for item in items])
+        gate = self.rules.score_batch(items)
+        return hashed, gate
+
+    def score(self, features):
+        hashed, gate = features
+        logits = hashed @ self.coef + self.intercept
+        return gate / (1.0 + np.exp(-logits))
+
+def reddit_text(submission):
+    """Text of a submission for text models: its title and body"""
+    return submission.title + "\n" + submission.selftext
+
+def create_model(conf, section, rules, text):
+    """
+    Create the notability model named in conf (section.notabilityModel),
+    defaulting to the rules alone.
+    """
+    name = "blacklist"
+    if conf.has_option(section, "notabilityModel"):
+        name = conf.get(section, "notabilityModel")
+    if name == "blacklist":
+        return rules
+    if name == "linear":
+        threshold = 0.5
+        if conf.has_option(section, "notabilityThreshold"):
+            threshold = conf.getfloat(section, "notabilityThreshold")
+        return LinearTextModel(conf.get(section, "notabilityWeightsLoc"),
+                               rules,
+                               text,
+                               threshold)
+    raise ValueError("unknown notability model: " + name)
+
+def create_tweet_model(conf, user_blacklist=None, kw_blacklist=None):
+    """Create the notability model for tweets from conf"""
+    rules = TweetBlacklistModel(user_blacklist, kw_blacklist)
+    return create_model(conf, "twitter", rules, get_full_text)
+
+def create_reddit_model(conf, user_blacklist=None, kw_blacklist=None):
+    """Create the notability model for Reddit submissions from conf"""
+    rules = RedditBlacklistModel(user_blacklist, kw_blacklist)
+    return create_model(conf, "reddit", rules, reddit_text)
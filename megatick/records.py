@@ -0,0 +1,152 @@
+"""
+Compact records of tweets and their authors, holding only the fields that
+Megatick uses, to keep queued statuses small during a backlog.
+"""
+
+from tweepy.utils import parse_datetime, parse_html_value
+
+from megatick.utils import get_full_text, get_urls
+
+class UserRecord:
+    """The fields of a Twitter user that Megatick records"""
+    __slots__ = ("id",
+                 "id_str",
+                 "screen_name",
+                 "name",
+                 "created_at",
+                 "url",
+                 "favourites_count",
+                 "statuses_count",
+                 "description",
+                 "location",
+                 "verified",
+                 "following",
+                 "listed_count",
+                 "followers_count",
+                 "default_profile_image",
+                 "utc_offset",
+                 "friends_count",
+                 "default_profile",
+                 "lang",
+                 "geo_enabled",
+                 "time_zone")
+
+    @classmethod
+    def from_user(cls, user):
+        """Copy the recorded fields of a tweepy User"""
+        record = cls()
+        for field in cls.__slots__:
+            setattr(record, field, getattr(user, field, None))
+        return record
+
+    @classmethod
+    def from_json(cls, data):
+        """Build a record straight from a user's JSON (as a dict)"""
+        record = cls()
+        for field in cls.__slots__:
+            setattr(record, field, data.get(field))
+        if record.created_at is not None:
+            record.created_at = parse_datetime(record.created_at)
+        return record
+
+class StatusRecord:
+    """
+    The fields of a tweet that Megatick uses to judge, record and follow it.
+    Only the full text is kept; text gives the same (full) text.
+    """
+    __slots__ = ("id",
+                 "id_str",
+                 "full_text",
+                 "created_at",
+                 "geo",
+                 "lang",
+                 "place",
+                 "coordinates",
+                 "favorite_count",
+                 "retweeted",
+                 "source",
+                 "favorited",
+                 "retweet_count",
+                 "is_quote_status",
+                 "quoted_status_id",
+                 "in_reply_to_status_id",
+                 "urls",
+                 "user")
+
+    @property
+    def text(self):
+        """The text of the tweet (always the full text)"""
+        return self.full_text
+
+    @classmethod
+    def from_status(cls, status):
+        """Copy the used fields of a tweepy Status (or return a record as is)"""
+        if isinstance(status, cls):
+            return status
+        record = cls()
+        record.id = status.id
+        record.id_str = status.id_str
+        record.full_text = get_full_text(status)
+        record.created_at = status.created_at
+        record.geo = status.geo
+        record.lang = status.lang
+        place = getattr(status, "place", None)
+        record.place = None if place is None else place.full_name
+        record.coordinates = status.coordinates
+        record.favorite_count = status.favorite_count
+        record.retweeted = status.retweeted
+        record.source = status.source
+        record.favorited = status.favorited
+        record.retweet_count = status.retweet_count
+        record.is_quote_status = status.is_quote_status
+        record.quoted_status_id = getattr(status, "quoted_status_id", None)
+        record.in_reply_to_status_id = status.in_reply_to_status_id
+        record.urls = tuple(get_urls(status))
+        record.user = UserRecord.from_user(status.user)
+        return record
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Build a record straight from a tweet's JSON (as a dict), without
+        building tweepy models first
+        """
+        record = cls()
+        record.id = data["id"]
+        record.id_str = data["id_str"]
+        record.full_text = raw_full_text(data)
+        record.created_at = parse_datetime(data["created_at"])
+        record.geo = data.get("geo")
+        record.lang = data.get("lang")
+        place = data.get("place")
+        record.place = None if place is None else place.get("full_name")
+        record.coordinates = data.get("coordinates")
+        record.favorite_count = data.get("favorite_count")
+        record.retweeted = data.get("retweeted")
+        source = data.get("source")
+        if source is not None and "<" in source:
+            source = parse_html_value(source)
+        record.source = source
+        record.favorited = data.get("favorited")
+        record.retweet_count = data.get("retweet_count")
+        record.is_quote_status = data.get("is_quote_status", False)
+        record.quoted_status_id = data.get("quoted_status_id")
+        record.in_reply_to_status_id = data.get("in_reply_to_status_id")
+        record.urls = tuple(url["expanded_url"]
+                            for url in raw_entities(data).get("urls", ()))
+        record.user = UserRecord.from_json(data["user"])
+        return record
+
+def raw_full_text(data):
+    """The full text of a tweet's JSON, regardless of its length"""
+    if "extended_tweet" in data:
+        return data["extended_tweet"]["full_text"]
+    if "full_text" in data:
+        return data["full_text"]
+    return data["text"]
+
+def raw_entities(data):
+    """The entities of a tweet's JSON (of the extended tweet if present)"""
+    if "extended_tweet" in data:
+        return data["extended_tweet"].get("entities", {})
+    return data.get("entities", {})
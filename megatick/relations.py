@@ -9,8 +9,13 @@ from py2neo import Relationship
 # TwitterUser -(AUTHORED)-> Tweet
 AUTHORED = Relationship.type("AUTHORED")
 
+# RedditComment    -(LINKS_TO)-> RedditSubmission
 # RedditComment    -(LINKS_TO)-> WebPage
 # RedditSubmission -(LINKS_TO)-> WebPage
 # Tweet            -(LINKS_TO)-> WebPage
 # WebPage          -(LINKS_TO)-> WebPage
 LINKS_TO = Relationship.type("LINKS_TO")
+
+# Tweet   -(DUPLICATE_OF)-> Tweet
+# WebPage -(DUPLICATE_OF)-> WebPage
+DUPLICATE_OF = Relationship.type("DUPLICATE_OF")
@@ -0,0 +1,203 @@
+"""
+Retention of heavy node properties (page content, tweet and Reddit text):
+bodies older than a set age are moved out of the graph into compressed,
+time-partitioned archive files, leaving a reference on the node from which
+they can be read back or restored.
+
+Each partition (a month, by default) is one file of concatenated gzip
+members, one member per batch, each holding one JSON record per line. A
+reference gives the file, the offset and length of the member, and the line.
+"""
+
+import configparser
+from datetime import datetime, timezone
+import gzip
+import json
+import os
+import time
+
+from megatick.database import snake_case
+from megatick.embedded import EmbeddedGraph
+from megatick.utils import create_graph
+
+# label -> (key property, heavy property, time property)
+RETAINED = {"WebPage": ("url", "content", "fetched_at"),
+            "Tweet": ("tweet_id", "text", "created_at"),
+            "RedditSubmission": ("submission_id", "text", "created_at"),
+            "RedditComment": ("comment_id", "body", "created_at")}
+
+def timestamp(value):
+    """Unix time of a stored time (a number, or a naive UTC datetime)"""
+    if hasattr(value, "to_native"):
+        value = value.to_native()
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+class Archive:
+    """Time-partitioned, append-only files of archived property values"""
+    def __init__(self, directory, partition_format="%Y-%m"):
+        self.directory = directory
+        self.partition_format = partition_format
+        os.makedirs(directory, exist_ok=True)
+
+    def partition(self, when):
+        """The name of the partition file for a Unix time"""
+        return time.strftime(self.partition_format,
+                             time.gmtime(when)) + ".jsonl.gz"
+
+    def write(self, partition, records):
+        """
+        Append records (dicts) to a partition as one gzip member, flushed to
+        disk before returning. Returns a reference to each record.
+        """
+        member = gzip.compress("\n".join(json.dumps(record, default=str)
+                                         for record in records)
+                               .encode("utf-8"))
+        with open(os.path.join(self.directory, partition), "ab") as out_file:
+            offset = out_file.tell()
+            out_file.write(member)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        return ["%s:%d:%d:%d" % (partition, offset, len(member), line)
+                for line in range(len(records))]
+
+    def read(self, reference):
+        """The record a reference (from write) points to"""
+        partition, offset, length, line = reference.rsplit(":", 3)
+        with open(os.path.join(self.directory, partition), "rb") as in_file:
+            in_file.seek(int(offset))
+            member = in_file.read(int(length))
+        return json.loads(gzip.decompress(member).split(b"\n")[int(line)])
+
+def update_properties(graph, node, properties):
+    """
+    Set (or, with None, remove) some properties of a node in the graph,
+    leaving the others as they are there
+    """
+    if isinstance(graph, EmbeddedGraph):
+        graph.update(node, properties)
+    else:
+        graph.run("MATCH (n) WHERE id(n) = $identity SET n += $properties",
+                  identity=node.identity,
+                  properties=properties)
+        node.update(properties)
+
+def create_archive(conf):
+    """
+    Return the Archive at DEFAULT.archiveLoc, or None if no archive is
+    configured
+    """
+    if not conf.has_option("DEFAULT", "archiveLoc"):
+        return None
+    partition_format = "%Y-%m"
+    if conf.has_option("DEFAULT", "archivePartition"):
+        partition_format = conf.get("DEFAULT", "archivePartition")
+    return Archive(conf.get("DEFAULT", "archiveLoc"), partition_format)
+
+def read_archived(archive, node):
+    """The archived heavy property of a node, or None if not archived"""
+    if node.get("archived") is None:
+        return None
+    return archive.read(node["archived"])["value"]
+
+def restore(graph, archive, node):
+    """Put a node's archived heavy property back into the graph"""
+    if node.get("archived") is None:
+        return
+    record = archive.read(node["archived"])
+    update_properties(graph,
+                      node,
+                      {record["property"]: record["value"], "archived": None})
+
+class RetentionJob:
+    """
+    Moves heavy properties of nodes older than DEFAULT.retentionDays (default
+    30) into the archive, in batches of DEFAULT.archiveBatchSize (default
+    1000)
+    """
+    def __init__(self, conf=None, graph=None):
+        # load default conf if none is provided
+        if conf is None:
+            # load default configuration
+            self.conf = configparser.ConfigParser()
+            self.conf.read("config.ini")
+        else:
+            self.conf = conf
+
+        self.graph = graph if graph is not None else create_graph(self.conf)
+        self.archive = create_archive(self.conf)
+        if self.archive is None:
+            raise ValueError("No archive configured at DEFAULT.archiveLoc")
+
+        self.max_age = 30 * 24 * 60 * 60
+        if self.conf.has_option("DEFAULT", "retentionDays"):
+            self.max_age = (self.conf.getfloat("DEFAULT", "retentionDays") *
+                            24 * 60 * 60)
+        self.batch_size = 1000
+        if self.conf.has_option("DEFAULT", "archiveBatchSize"):
+            self.batch_size = self.conf.getint("DEFAULT", "archiveBatchSize")
+
+    def old_nodes(self, label, cutoff):
+        """Yield batches of nodes with this label holding content to move"""
+        _, name, time_name = RETAINED[label]
+        if isinstance(self.graph, EmbeddedGraph):
+            # scan in ID order, as times aren't indexed
+            after = 0
+            while True:
+                nodes = self.graph.scan(label, name, after, self.batch_size)
+                if not nodes:
+                    return
+                after = nodes[-1].identity
+                yield [node for node in nodes
+                       if node.get(time_name) is not None and
+                       timestamp(node[time_name]) < cutoff]
+        else:
+            self.graph.run("CREATE INDEX %s_%s IF NOT EXISTS "
+                           "FOR (n:%s) ON (n.%s)" %
+                           (snake_case(label), time_name, label, time_name))
+            if label == "Tweet":
+                # stored as a (naive, UTC) datetime
+                cutoff = datetime.utcfromtimestamp(cutoff)
+            while True:
+                # moved nodes no longer match, so each query gets new ones
+                nodes = [record[0] for record in self.graph.run(
+                    "MATCH (n:%s) WHERE n.%s < $cutoff AND n.%s IS NOT NULL "
+                    "RETURN n LIMIT $limit" % (label, time_name, name),
+                    cutoff=cutoff,
+                    limit=self.batch_size)]
+                if not nodes:
+                    return
+                yield nodes
+
+    def archive_nodes(self, label, nodes):
+        """Move the heavy property of these nodes into the archive"""
+        key_name, name, time_name = RETAINED[label]
+        partitions = {}
+        for node in nodes:
+            partition = self.archive.partition(timestamp(node[time_name]))
+            partitions.setdefault(partition, []).append(node)
+        for partition, members in partitions.items():
+            # write the archive first, so a crash never loses content
+            references = self.archive.write(partition,
+                                            [{"label": label,
+                                              "key": node[key_name],
+                                              "property": name,
+                                              "value": node[name]}
+                                             for node in members])
+            for node, reference in zip(members, references):
+                update_properties(self.graph,
+                                  node,
+                                  {name: None, "archived": reference})
+
+    def run(self):
+        """Archive everything older than the retention age"""
+        cutoff = time.time() - self.max_age
+        for label in RETAINED:
+            count = 0
+            for nodes in self.old_nodes(label, cutoff):
+                self.archive_nodes(label, nodes)
+                count += len(nodes)
+            print("Archived %d %s nodes" % (count, label))
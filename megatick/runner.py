@@ -0,0 +1,81 @@
+"""
+Run several monitors in a single process, sharing one graph connection and
+one scraper (and so its threads and caches) between them.
+"""
+
+import configparser
+import json
+from threading import Thread
+
+from megatick.monitors import RedditMonitor, RssMonitor, TwitterMonitor
+from megatick.scraper import Scraper
+from megatick.tracing import install_hooks
+from megatick.utils import create_graph
+
+# monitors that can be run, by the name used in config.ini
+MONITORS = {"twitter": TwitterMonitor,
+            "reddit": RedditMonitor,
+            "rss": RssMonitor}
+
+# monitors that always scrape cited pages, building a scraper (and so a
+# graph for it) of their own if none is shared with them
+SCRAPING = ["reddit", "rss"]
+
+class MonitorRunner:
+    """Host any combination of monitors in one process"""
+    def __init__(self, conf=None, sources=None):
+        """Initialization"""
+        # load default conf if none is provided
+        if conf is None:
+            # load default configuration
+            self.conf = configparser.ConfigParser()
+            self.conf.read("config.ini")
+        else:
+            self.conf = conf
+
+        # which monitors to run (from conf), defaulting to all of them
+        if sources is None:
+            if self.conf.has_option("runner", "sources"):
+                sources = json.loads(self.conf.get("runner", "sources"))
+            else:
+                sources = list(MONITORS)
+        unknown = [source for source in sources if source not in MONITORS]
+        if len(unknown) > 0:
+            raise ValueError("unknown monitor(s): " + ", ".join(unknown))
+        self.sources = sources
+
+        # create the one Neo4j Graph object if necessary
+        if self.conf.getboolean("neo4j", "useNeo4j"):
+            print("Attempting to load graph")
+            self.graph = create_graph(self.conf)
+        else:
+            self.graph = None
+
+        # a single scraper, so a url cited from several sources is fetched
+        # once and the same worker threads serve all monitors. Without a
+        # graph, Twitter doesn't scrape, but the others still would.
+        if (self.graph is not None or
+                any(source in SCRAPING for source in self.sources)):
+            self.scraper = Scraper(self.conf, self.graph)
+        else:
+            self.scraper = None
+
+        self.monitors = [MONITORS[source](conf=self.conf,
+                                          graph=self.graph,
+                                          scraper=self.scraper)
+                         for source in self.sources]
+
+    def start(self):
+        """Start every monitor in its own thread and wait on them"""
+        # from the main thread, so that the signal handlers can be set
+        install_hooks(self.conf)
+
+        threads = []
+        for source, monitor in zip(self.sources, self.monitors):
+            print("Starting " + source + " monitor")
+            thread = Thread(target=monitor.start, name=source)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
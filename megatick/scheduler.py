@@ -0,0 +1,191 @@
+"""
+Schedule URL downloads across hosts: each host gets its own sub-queue with a
+minimum delay between requests and a cap on concurrent requests, and among
+the hosts that can take a request, the URL with the most citers waiting on
+it goes first.
+
+Each host also has a circuit breaker: after repeated failures its URLs are
+held back for a cooldown, after which a single probe request decides whether
+to resume (or to wait twice as long).
+"""
+
+import heapq
+import itertools
+import time
+from threading import Condition
+from urllib.parse import urlsplit
+
+class HostQueue:
+    """Pending URLs and politeness state for a single host"""
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        self.concurrency = concurrency
+        # entries are (-priority, sequence, url); stale entries are skipped
+        self.heap = []
+        self.active = 0
+        self.next_time = 0.0
+        # circuit breaker: consecutive failures, when an open circuit may be
+        # probed (0 when closed), and whether a probe is in flight
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = None
+        self.probing = False
+
+class HostScheduler:
+    """
+    Thread-safe replacement for a FIFO queue of URLs. Producers put (url,
+    citer) pairs and workers get (url, citers) tasks, marking each one done.
+    """
+    def __init__(self, delay=1.0, concurrency=2, policies=None,
+                 max_failures=5, cooldown=60.0, max_cooldown=3600.0):
+        # default minimum seconds between requests to, and maximum
+        # simultaneous requests to, any one host
+        self.delay = delay
+        self.concurrency = concurrency
+        # per-host (delay, concurrency) overrides
+        self.policies = {} if policies is None else policies
+        # consecutive failures that open a host's circuit, and the seconds
+        # (doubling while probes fail) before it is probed
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.condition = Condition()
+        self.tasks = {}
+        self.hosts = {}
+        self.sequence = itertools.count()
+
+    def host_queue(self, host):
+        """Return the HostQueue for host, creating it if necessary"""
+        queue = self.hosts.get(host)
+        if queue is None:
+            delay, concurrency = self.policies.get(host, (self.delay,
+                                                          self.concurrency))
+            queue = HostQueue(delay, concurrency)
+            queue.cooldown = self.cooldown
+            self.hosts[host] = queue
+        return queue
+
+    def put(self, url, citer):
+        """
+        Schedule url to be downloaded and linked to citer. A url already
+        waiting gains citer and moves up in priority rather than being
+        downloaded twice.
+        """
+        host = urlsplit(url).netloc
+        with self.condition:
+            citers = self.tasks.setdefault(url, [])
+            citers.append(citer)
+            queue = self.host_queue(host)
+            heapq.heappush(queue.heap,
+                           (-len(citers), next(self.sequence), url))
+            self.condition.notify()
+
+    def pop_ready(self, now):
+        """
+        Pop the best url from the hosts that can take a request now and
+        return it with its HostQueue, or return None with the time of the
+        next opportunity (None if there is nothing to wait for).
+        """
+        best = None
+        wake = None
+        for host in list(self.hosts):
+            queue = self.hosts[host]
+            # drop stale entries (superseded by a higher priority)
+            while (queue.heap and
+                   len(self.tasks.get(queue.heap[0][2], ())) !=
+                   -queue.heap[0][0]):
+                heapq.heappop(queue.heap)
+            if not queue.heap:
+                # forget idle hosts, including those whose circuit opened
+                # but whose cooldown is over (a new queue starts closed)
+                if (queue.active == 0 and queue.next_time <= now and
+                        queue.open_until <= now):
+                    del self.hosts[host]
+                continue
+            if queue.active >= queue.concurrency:
+                continue
+            if queue.open_until:
+                # open circuit: hold urls back until the cooldown is over,
+                # then let through one probe at a time
+                if queue.open_until > now:
+                    if wake is None or queue.open_until < wake:
+                        wake = queue.open_until
+                    continue
+                if queue.active > 0:
+                    continue
+            if queue.next_time > now:
+                if wake is None or queue.next_time < wake:
+                    wake = queue.next_time
+                continue
+            if best is None or queue.heap[0] < best.heap[0]:
+                best = queue
+        if best is None:
+            return None, wake
+        _, _, url = heapq.heappop(best.heap)
+        return url, best
+
+    def get(self):
+        """Block until a url can be downloaded and return (url, citers)"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                url, ready = self.pop_ready(now)
+                if url is not None:
+                    ready.active += 1
+                    ready.next_time = now + ready.delay
+                    ready.probing = ready.open_until != 0.0
+                    return url, self.tasks.pop(url)
+                # nothing ready; sleep until a host's delay has passed
+                if ready is None:
+                    self.condition.wait()
+                else:
+                    self.condition.wait(ready - now)
+
+    def task_done(self, url):
+        """Mark the download of url complete, freeing a slot for its host"""
+        with self.condition:
+            self.host_queue(urlsplit(url).netloc).active -= 1
+            self.condition.notify_all()
+
+    def report(self, url, ok):
+        """
+        Record whether a request for url reached its host (ok) or failed to
+        (e.g. could not connect, timed out, or a server error), opening or
+        closing the host's circuit accordingly
+        """
+        host = urlsplit(url).netloc
+        with self.condition:
+            queue = self.host_queue(host)
+            if ok:
+                if queue.open_until:
+                    print("Circuit closed for " + host)
+                queue.failures = 0
+                queue.open_until = 0.0
+                queue.cooldown = self.cooldown
+                queue.probing = False
+            elif queue.probing:
+                # the probe failed: wait twice as long before the next
+                queue.probing = False
+                queue.cooldown = min(2 * queue.cooldown, self.max_cooldown)
+                queue.open_until = time.monotonic() + queue.cooldown
+                print("Circuit still open for %s (%.0f s)" %
+                      (host, queue.cooldown))
+            elif not queue.open_until:
+                queue.failures += 1
+                if queue.failures >= self.max_failures:
+                    queue.open_until = time.monotonic() + queue.cooldown
+                    print("Circuit open for %s (%.0f s)" %
+                          (host, queue.cooldown))
+            self.condition.notify_all()
+
+    def qsize(self):
+        """Number of urls waiting to be downloaded"""
+        with self.condition:
+            return len(self.tasks)
+
+    def pending(self):
+        """Number of urls waiting to be downloaded or being downloaded"""
+        with self.condition:
+            return len(self.tasks) + sum(queue.active
+                                         for queue in self.hosts.values())
@@ -2,49 +2,90 @@
 Get markdown version of website body content in a threaded fashion
 """
 
+from collections import namedtuple
 import configparser
 import re
+import time
 from queue import Queue
-from threading import Thread
+from threading import Event, Lock, Thread
 from urllib.parse import urlparse
 import requests
 
 from bs4 import BeautifulSoup as bs
 from markdownify import markdownify as md
-from py2neo import NodeMatcher
 
+from megatick.canonical import Canonicalizer
+from megatick.database import merge_counted
+from megatick.dedup import create_dedup_index
+from megatick.dnscache import install_dns_cache
 from megatick.nodes import WebPage
-from megatick.relations import LINKS_TO
-from megatick.utils import create_graph, url_is_valid, tidify_url
+from megatick.relations import DUPLICATE_OF, LINKS_TO
+from megatick.retention import create_archive, read_archived, update_properties
+from megatick.scheduler import HostScheduler
+from megatick.search import create_search_index
+from megatick.tracing import TRACER
+from megatick.utils import create_graph, url_is_valid
+from megatick.writer import create_graph_writer
+
+# result of fetching a page: its markdown content (None if unavailable or
+# unchanged), its HTTP validators, whether the server answered 304, and
+# whether the host could not be reached (or answered with a server error)
+Fetched = namedtuple("Fetched",
+                     ["content", "etag", "last_modified", "not_modified",
+                      "failed"])
+
+@TRACER.trace("retrieve_url")
+def fetch_url(url, etag=None, last_modified=None, timeout=None):
+    """
+    Retrieve the markdown version of a site given a URL. If validators from
+    an earlier fetch are given, the request is conditional and an unchanged
+    page comes back as not_modified without content. Connecting and each
+    read give up after timeout seconds, if given.
+    """
+    content = None
+    if not url_is_valid(url):
+        return Fetched(None, None, None, False, False)
+
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = requests.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return Fetched(None, etag, last_modified, True, False)
+        if response.status_code != 200:
+            print("%d status code for %s" % (response.status_code, url))
+        elif re.match("^https?://twitter.com/", response.url):
+            print("tried to download a tweet")
+        elif response.status_code == 200:
+            soup = bs(response.content, features='html.parser')
+            body = soup.find('body')
+            if body is not None:
+                print('found content for', url)
+                for script in soup(["script", "style", "img"]):
+                    script.decompose()
+                content = md(str(body))
+        return Fetched(content,
+                       response.headers.get("ETag"),
+                       response.headers.get("Last-Modified"),
+                       False,
+                       response.status_code >= 500)
+    except requests.exceptions.ConnectionError as errc:
+        print("Error Connecting:", errc)
+    except requests.exceptions.Timeout as errt:
+        print("Timeout Error:", errt)
+    except requests.exceptions.RequestException as err:
+        print("Error:", err)
+        return Fetched(None, None, None, False, False)
+
+    return Fetched(None, None, None, False, True)
 
 def retrieve_url(url):
     """Retrieve the markdown version of a site given a URL"""
-    content = None
-    # TODO: remove cruft at the end of URLs, e.g. site.com/bob.html?u=103&t=7
-    if url_is_valid(url):
-        try:
-            url = tidify_url(url)
-            response = requests.get(url)
-            if response.status_code != 200:
-                print("%d status code for %s" % (response.status_code, url))
-            elif re.match("^https?://twitter.com/", response.url):
-                print("tried to download a tweet")
-            elif response.status_code == 200:
-                soup = bs(response.content, features='html.parser')
-                body = soup.find('body')
-                if body is not None:
-                    print('found content for', url)
-                    for script in soup(["script", "style", "img"]):
-                        script.decompose()
-                    content = md(str(body))
-        except requests.exceptions.ConnectionError as errc:
-            print("Error Connecting:", errc)
-        except requests.exceptions.Timeout as errt:
-            print("Timeout Error:", errt)
-        except requests.exceptions.RequestException as err:
-            print("Error:", err)
-
-    return content
+    return fetch_url(url).content
 
 class Scraper:
     """
@@ -63,7 +104,11 @@ class Scraper:
             self.graph = create_graph(conf)
         else:
             self.graph = graph
-        self.matcher = NodeMatcher(self.graph)
+        self.matcher = self.graph.nodes
+
+        # pool of threads writing to the graph, with writes for the same url
+        # going to the same writer
+        self.writer = create_graph_writer(conf, self.graph)
 
         # domains to ignore
         self.blacklist = None
@@ -71,12 +116,95 @@ class Scraper:
             with open(conf.get("DEFAULT", "domainBlacklistLoc"), "r") as bl_file:
                 self.blacklist = [line.strip() for line in bl_file]
 
-        # queue for sites to download
+        # age in hours after which a cited page is re-validated
+        self.refresh_age = 24.0
+        if conf.has_option("DEFAULT", "refreshAge"):
+            self.refresh_age = conf.getfloat("DEFAULT", "refreshAge")
+
+        # fingerprints of recent pages, so that syndicated copies of an
+        # article are linked to the first copy rather than stored in full.
+        # Off unless DEFAULT.pageDuplicates is set: whole pages are
+        # fingerprinted, and different articles on one site can share most
+        # of their text (navigation, footers, banners).
+        self.dedup = None
+        if (conf.has_option("DEFAULT", "pageDuplicates") and
+                conf.getboolean("DEFAULT", "pageDuplicates")):
+            self.dedup = create_dedup_index(conf)
+
+        # local full-text index of downloaded pages (None if unused)
+        self.search_index = create_search_index(conf)
+
+        # archive of contents moved out of the graph (None if unused)
+        self.archive = create_archive(conf)
+
+        # resolves shortened links and strips cruft like tracking parameters
+        self.canonicalizer = Canonicalizer(conf)
+
+        # urls currently being downloaded, so that a url cited by several
+        # sources at once is only fetched once
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+
+        # per-host politeness: seconds between requests and simultaneous
+        # requests, by default and for particular hosts (one "host delay
+        # concurrency" per line)
+        host_delay = 1.0
+        if conf.has_option("DEFAULT", "hostDelay"):
+            host_delay = conf.getfloat("DEFAULT", "hostDelay")
+        host_concurrency = 2
+        if conf.has_option("DEFAULT", "hostConcurrency"):
+            host_concurrency = conf.getint("DEFAULT", "hostConcurrency")
+        policies = {}
+        if conf.has_option("DEFAULT", "hostPolicyLoc"):
+            with open(conf.get("DEFAULT", "hostPolicyLoc"), "r") as pol_file:
+                for line in pol_file:
+                    if line.strip():
+                        host, delay, concurrency = line.split()
+                        policies[host] = (float(delay), int(concurrency))
+
+        # per-host circuit breaker: consecutive failures before a host's
+        # urls are held back, and for how many seconds at first (doubling,
+        # up to the maximum, while the host stays down)
+        host_failures = 5
+        if conf.has_option("DEFAULT", "hostFailures"):
+            host_failures = conf.getint("DEFAULT", "hostFailures")
+        host_cooldown = 60.0
+        if conf.has_option("DEFAULT", "hostCooldown"):
+            host_cooldown = conf.getfloat("DEFAULT", "hostCooldown")
+        host_max_cooldown = 3600.0
+        if conf.has_option("DEFAULT", "hostMaxCooldown"):
+            host_max_cooldown = conf.getfloat("DEFAULT", "hostMaxCooldown")
+
+        # seconds to wait for a host to accept a connection or send data
+        self.timeout = 10.0
+        if conf.has_option("DEFAULT", "urlTimeout"):
+            self.timeout = conf.getfloat("DEFAULT", "urlTimeout")
+
+        # reuse DNS lookups rather than repeating them for every request
+        install_dns_cache(conf)
+
+        # queue of (citer, urls) as they are cited, and the per-host
+        # schedule of canonical urls to download
         self.queue = Queue(maxsize=0)
+        self.scheduler = HostScheduler(host_delay,
+                                       host_concurrency,
+                                       policies,
+                                       host_failures,
+                                       host_cooldown,
+                                       host_max_cooldown)
+
+        # canonicalizing can mean resolving redirects, so use a few threads
+        num_resolve_threads = 2
+        if conf.has_option("DEFAULT", "numResolveThreads"):
+            num_resolve_threads = conf.getint("DEFAULT", "numResolveThreads")
+        for _ in range(num_resolve_threads):
+            thread = Thread(target=self.schedule_urls, daemon=True)
+            thread.start()
+
         threads = []
         num_threads = conf.getint("DEFAULT", "numUrlThreads")
         for _ in range(num_threads):
-            thread = Thread(target=self.add_urls)
+            thread = Thread(target=self.add_urls, daemon=True)
             thread.start()
             threads.append(thread)
 
@@ -86,17 +214,110 @@ class Scraper:
         be linked to the citer. Otherwise, try to create a new node.
         """
         match = self.matcher.match("WebPage", url=url).first()
-        if match is None:
-            content = retrieve_url(url)
-            if content is not None:
-                web_site = WebPage(url,
-                                   content)
-                web_site.add_to(self.graph)
-                web_site
-            else:
-                None
-        else:
-            match
+        if match is not None:
+            if self.is_stale(match):
+                self.refresh(match)
+            return match
+
+        # wait for another thread already downloading this url
+        with self.in_flight_lock:
+            done = self.in_flight.get(url)
+            if done is None:
+                self.in_flight[url] = Event()
+        if done is not None:
+            done.wait()
+            return self.matcher.match("WebPage", url=url).first()
+
+        try:
+            fetched = fetch_url(url, timeout=self.timeout)
+            self.scheduler.report(url, not fetched.failed)
+            if fetched.content is None:
+                return None
+            original = self.find_original(url, fetched.content)
+            content = fetched.content if original is None else None
+            web_site = WebPage(url,
+                               content,
+                               time.time(),
+                               fetched.etag,
+                               fetched.last_modified)
+            if original is not None:
+                web_site["duplicate_of"] = original["url"]
+            self.writer.call(url, self.add_page, web_site, original)
+            return web_site
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.pop(url).set()
+
+    def add_page(self, web_site, original=None):
+        """Add a new WebPage node, linked to the page it duplicates, if any"""
+        web_site.add_to(self.graph, self.search_index)
+        if original is not None:
+            self.graph.merge(DUPLICATE_OF(web_site, original))
+
+    def find_original(self, url, content):
+        """
+        Return the WebPage node that content is a near-duplicate of, if any.
+        """
+        if self.dedup is None:
+            return None
+        original_url = self.dedup.check(url, content)
+        if original_url is None:
+            return None
+        return self.matcher.match("WebPage", url=original_url).first()
+
+    def is_stale(self, web_page):
+        """True if a WebPage was fetched longer than refresh_age hours ago"""
+        fetched_at = web_page.get("fetched_at")
+        if fetched_at is None:
+            return True
+        return time.time() - fetched_at > self.refresh_age * 3600
+
+    def refresh(self, web_page):
+        """
+        Re-validate a WebPage with a conditional request, rewriting its
+        content only if it has actually changed.
+        """
+        fetched = fetch_url(web_page["url"],
+                            web_page.get("etag"),
+                            web_page.get("last_modified"),
+                            self.timeout)
+        self.scheduler.report(web_page["url"], not fetched.failed)
+        if not fetched.not_modified and fetched.content is None:
+            # unavailable for now; keep the old content and retry later
+            return
+        # only the properties changed here are written, leaving counters
+        # updated meanwhile by other writers as they are
+        changed = {"fetched_at": time.time()}
+        if not fetched.not_modified:
+            changed["etag"] = fetched.etag
+            changed["last_modified"] = fetched.last_modified
+            # near-duplicates keep pointing at their original instead
+            if (web_page.get("duplicate_of") is None and
+                    fetched.content != self.stored_content(web_page)):
+                changed["content"] = fetched.content
+                # the new content supersedes any archived copy (whose record
+                # stays in the append-only archive, no longer referenced)
+                if web_page.get("archived") is not None:
+                    changed["archived"] = None
+                if self.search_index is not None:
+                    self.search_index.add("WebPage",
+                                          web_page["url"],
+                                          None,
+                                          fetched.content)
+        self.writer.call(web_page["url"],
+                         update_properties,
+                         self.graph,
+                         web_page,
+                         changed)
+
+    def stored_content(self, web_page):
+        """
+        The content of a WebPage, read back from the archive if it has been
+        moved there
+        """
+        if web_page.get("content") is None and self.archive is not None:
+            return read_archived(self.archive, web_page)
+        return web_page.get("content")
 
     def remove_blacklisted(self, urls):
         """Filter out urls that match blacklisted domains"""
@@ -106,31 +327,76 @@ class Scraper:
             return [url for url in urls
                     if urlparse(url).netloc not in self.blacklist]
 
-    def add_urls(self):
+    def schedule_urls(self):
         """
-        Add citees to graph and links citer to citees via LinksTo relations.
-        Assumes citer is already in the graph.
+        Canonicalize and filter cited urls, then schedule them for download.
         """
         while True:
-            # pull a task from the download queue
+            # pull a task from the citation queue
             citer, urls = self.queue.get()
 
-            # filter out forbidden domains
-            whitelisted = self.remove_blacklisted(urls)
+            # reduce each url to its canonical form (once per article)
+            canonical = []
+            for url in urls:
+                url = self.canonicalizer.canonicalize(url)
+                if url not in canonical:
+                    canonical.append(url)
 
-            # download new sites and get nodes of previously downloaded sites
-            # TODO: consider using date to update old sites
-            web_pages = [self.get_or_add(url) for url in whitelisted]
+            # filter out forbidden domains
+            whitelisted = self.remove_blacklisted(canonical)
 
-            # connect citer (node) to WebPage nodes
-            for web_page in web_pages:
-                if citer is not None:
-                    links_to = LINKS_TO(citer, web_page)
-                    self.graph.merge(links_to)
-                    # print('merged links_to')
+            for url in whitelisted:
+                # pages already stored and fresh need no download, so link
+                # them now rather than waiting for a slot at their host
+                try:
+                    web_page = self.matcher.match("WebPage", url=url).first()
+                    if web_page is not None and not self.is_stale(web_page):
+                        self.writer.call(url,
+                                         self.link_citers,
+                                         [citer],
+                                         web_page)
+                        continue
+                except Exception as error:
+                    print("Error schedule_urls: %s" % str(error))
+                self.scheduler.put(url, citer)
 
             self.queue.task_done()
 
+    def add_urls(self):
+        """
+        Add citees to graph and links citers to citees via LinksTo relations.
+        Assumes citers are already in the graph.
+        """
+        while True:
+            # pull the next url (and everything citing it) from the schedule
+            url, citers = self.scheduler.get()
+
+            try:
+                with TRACER.span("add_urls"):
+                    # download a new site or get the node of a downloaded
+                    # site, re-validating it if it is stale
+                    web_page = self.get_or_add(url)
+
+                    # connect citers (nodes) to the WebPage node
+                    if web_page is not None:
+                        self.writer.call(url,
+                                         self.link_citers,
+                                         citers,
+                                         web_page)
+            except Exception as error:
+                # keep downloading other urls
+                print("Error add_urls: %s" % str(error))
+
+            self.scheduler.task_done(url)
+
+    def link_citers(self, citers, web_page):
+        """Link each citer (node) to a WebPage node"""
+        for citer in citers:
+            if citer is not None:
+                links_to = LINKS_TO(citer, web_page)
+                merge_counted(self.graph, links_to)
+                # print('merged links_to')
+
     def link(self, citer, citees):
         """
         Add a citer and its citees to the queue to be downloaded and
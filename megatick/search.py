@@ -0,0 +1,116 @@
+"""
+Local full-text index (SQLite FTS5) of stored tweets, Reddit submissions and
+web pages, kept up to date from the same write path as the graph, so that
+keyword searches need not scan every node in the graph.
+"""
+
+import atexit
+import sqlite3
+import time
+from threading import Lock, Thread
+
+class SearchIndex:
+    """Incrementally maintained full-text index of graph nodes by key"""
+    def __init__(self, location, commit_interval=1.0):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(location,
+                                          timeout=30,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            # docs maps a node (label and key) to the rowid of its text
+            self.connection.execute("CREATE TABLE IF NOT EXISTS docs "
+                                    "(rowid INTEGER PRIMARY KEY, "
+                                    "label TEXT NOT NULL, "
+                                    "key NOT NULL, "
+                                    "UNIQUE (label, key))")
+            self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                                    "documents USING fts5(title, body, "
+                                    "tokenize='porter unicode61')")
+
+        # writes are committed in batches, at most commit_interval apart
+        self.dirty = False
+        self.commit_interval = commit_interval
+        thread = Thread(target=self.commit_periodically, daemon=True)
+        thread.start()
+        # don't lose the last writes on a normal exit
+        atexit.register(self.flush)
+
+    def add(self, label, key, title, body):
+        """Index (or re-index) the text of the node with this label and key"""
+        with self.lock:
+            row = self.connection.execute("SELECT rowid FROM docs "
+                                          "WHERE label = ? AND key = ?",
+                                          (label, key)).fetchone()
+            if row is None:
+                rowid = self.connection.execute("INSERT INTO docs (label, key) "
+                                                "VALUES (?, ?)",
+                                                (label, key)).lastrowid
+            else:
+                rowid = row[0]
+                self.connection.execute("DELETE FROM documents "
+                                        "WHERE rowid = ?", (rowid,))
+            self.connection.execute("INSERT INTO documents "
+                                    "(rowid, title, body) VALUES (?, ?, ?)",
+                                    (rowid, title or "", body or ""))
+            self.dirty = True
+
+    def remove(self, label, key):
+        """Remove the node with this label and key from the index"""
+        with self.lock:
+            row = self.connection.execute("SELECT rowid FROM docs "
+                                          "WHERE label = ? AND key = ?",
+                                          (label, key)).fetchone()
+            if row is not None:
+                self.connection.execute("DELETE FROM documents "
+                                        "WHERE rowid = ?", row)
+                self.connection.execute("DELETE FROM docs "
+                                        "WHERE rowid = ?", row)
+                self.dirty = True
+
+    def flush(self):
+        """Commit any pending writes"""
+        with self.lock:
+            if self.dirty:
+                self.connection.commit()
+                self.dirty = False
+
+    def commit_periodically(self):
+        """Commit pending writes every commit_interval seconds"""
+        while True:
+            time.sleep(self.commit_interval)
+            self.flush()
+
+    def query(self, text, labels=None, limit=20):
+        """
+        Search for text (FTS5 query syntax) and return up to limit (label,
+        key, score) tuples, most relevant first. labels optionally restricts
+        results to nodes with those labels, e.g. ["Tweet", "WebPage"].
+        """
+        sql = ("SELECT docs.label, docs.key, -bm25(documents) AS score "
+               "FROM documents JOIN docs ON docs.rowid = documents.rowid "
+               "WHERE documents MATCH ?")
+        params = [text]
+        if labels is not None:
+            sql += " AND docs.label IN (%s)" % ", ".join("?" * len(labels))
+            params.extend(labels)
+        sql += " ORDER BY bm25(documents) LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+# one index per location, shared by everything in this process
+INDEXES = {}
+INDEXES_LOCK = Lock()
+
+def create_search_index(conf):
+    """
+    Return the SearchIndex at DEFAULT.searchIndexLoc, or None if no index is
+    configured.
+    """
+    if not conf.has_option("DEFAULT", "searchIndexLoc"):
+        return None
+    location = conf.get("DEFAULT", "searchIndexLoc")
+    with INDEXES_LOCK:
+        if location not in INDEXES:
+            INDEXES[location] = SearchIndex(location)
+        return INDEXES[location]
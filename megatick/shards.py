@@ -0,0 +1,275 @@
+"""
+Split Twitter filters across several stream connections, each of which is
+limited in how many keywords and users it may track, optionally reading each
+connection in its own process. Every connection feeds the same listener,
+which drops tweets already seen on another connection. Each connection is
+kept up by a StreamSupervisor, and uses its own Twitter account (config
+sections twitter, twitter.2, twitter.3, ...), as Twitter allows only one
+stream connection per account. When the filters change, new connections are
+opened on spare accounts alongside the old ones, which are only closed once
+the new ones are live; without enough spare accounts, the old ones are
+closed first.
+"""
+
+import configparser
+import multiprocessing
+import time
+from threading import Event, Lock
+
+import tweepy
+
+# a faster JSON parser, if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from megatick.notability import TweetBlacklistModel
+from megatick.records import StatusRecord
+from megatick.supervisor import StreamSupervisor
+from megatick.utils import (create_twitter_auth, read_blacklists,
+                            twitter_accounts, watch_files)
+
+# per-connection limits of the filter endpoint
+MAX_TRACK = 400
+MAX_FOLLOW = 5000
+
+def partition_filters(keywords, users, num_streams=1):
+    """
+    Split keywords and users round-robin into (track, follow) pairs, one per
+    stream connection: num_streams of them, or more if needed to keep every
+    connection within MAX_TRACK keywords and MAX_FOLLOW users.
+    """
+    num_streams = max(num_streams,
+                      -(-len(keywords) // MAX_TRACK),
+                      -(-len(users) // MAX_FOLLOW),
+                      1)
+    shards = [(keywords[i::num_streams], users[i::num_streams])
+              for i in range(num_streams)]
+    # a connection with nothing to filter would be refused
+    return [(track, follow) for track, follow in shards if track or follow]
+
+def conf_to_dict(conf):
+    """Copy a configuration into a dict, so that it can be sent to a process"""
+    sections = {section: dict(conf.items(section, raw=True))
+                for section in conf.sections()}
+    sections["DEFAULT"] = dict(conf.items("DEFAULT", raw=True))
+    return sections
+
+class ShardListener(tweepy.StreamListener):
+    """
+    Parses stream data in a stream process, passing on to a (multiprocessing)
+    queue only what the listener needs: compact records of statuses passing
+    the blacklists, delete notices, and other messages as raw data
+    """
+    def __init__(self, conf, queue, live):
+        super().__init__()
+        self.conf = conf
+        self.queue = queue
+        self.live = live
+        self.load_blacklists()
+        watch_files(conf,
+                    [conf.get("twitter", "userBlacklistLoc", fallback=None),
+                     conf.get("twitter", "keywordBlacklistLoc",
+                              fallback=None)],
+                    self.load_blacklists)
+
+    def load_blacklists(self):
+        """Read the user and keyword blacklists into the prefilter"""
+        self.prefilter = TweetBlacklistModel(*read_blacklists(self.conf,
+                                                              "twitter"))
+
+    def on_connect(self):
+        self.live.set()
+
+    def on_error(self, status_code):
+        """Keep reconnecting unless our credentials are refused"""
+        print("Encountered error with status code:", status_code)
+        return status_code != 401
+
+    def on_data(self, raw_data):
+        try:
+            data = json_loads(raw_data)
+            if "in_reply_to_status_id" in data:
+                if self.prefilter.passes_raw(data):
+                    self.queue.put(("status", StatusRecord.from_json(data)))
+            elif "delete" in data:
+                status = data["delete"]["status"]
+                self.queue.put(("delete", (status["id"], status["user_id"])))
+            else:
+                self.queue.put(("data", raw_data))
+        except Exception as error:
+            print("Error on_data: %s" % str(error))
+        return True
+
+def create_supervisor(conf, auth, listener, track, follow, languages):
+    """A StreamSupervisor for one shard, configured from conf"""
+    stall_timeout = 90.0
+    if conf.has_option("twitter", "stallTimeout"):
+        stall_timeout = conf.getfloat("twitter", "stallTimeout")
+    max_backoff = 320.0
+    if conf.has_option("twitter", "maxBackoff"):
+        max_backoff = conf.getfloat("twitter", "maxBackoff")
+    return StreamSupervisor(auth,
+                            listener,
+                            track=track,
+                            follow=follow,
+                            languages=languages,
+                            stall_timeout=stall_timeout,
+                            max_backoff=max_backoff)
+
+def read_shard(conf_dict, account, track, follow, languages, queue, live,
+               stop):
+    """
+    Read one stream connection, with the credentials in config section
+    account, into queue until stop is set (run in its own process)
+    """
+    conf = configparser.ConfigParser()
+    conf.read_dict(conf_dict)
+    supervisor = create_supervisor(conf,
+                                   create_twitter_auth(conf, account),
+                                   ShardListener(conf, queue, live),
+                                   track,
+                                   follow,
+                                   languages)
+    supervisor.start()
+    stop.wait()
+    supervisor.close()
+
+class ProcessConnection:
+    """A stream connection read by its own process"""
+    def __init__(self, context, conf_dict, queue, account, track, follow,
+                 languages):
+        self.live = context.Event()
+        self.stop = context.Event()
+        self.process = context.Process(target=read_shard,
+                                       args=(conf_dict, account, track,
+                                             follow, languages, queue,
+                                             self.live, self.stop),
+                                       daemon=True)
+        self.process.start()
+
+    def close(self):
+        """
+        Stop reading. The process exits by itself, rather than being
+        terminated, so that the queue is left intact.
+        """
+        self.stop.set()
+
+class ShardedStream:
+    """
+    The stream connections currently reading for one listener, one per
+    (track, follow) shard, each on its own account
+    """
+    def __init__(self, conf, listener, languages=None, processes=False,
+                 swap_timeout=60.0):
+        self.conf = conf
+        self.listener = listener
+        self.languages = languages
+        self.processes = processes
+        self.swap_timeout = swap_timeout
+        self.accounts = twitter_accounts(conf)
+        self.connections = []
+        # the accounts the current connections are on
+        self.in_use = []
+        # only one set of connections is opened at a time
+        self.lock = Lock()
+        if processes:
+            # spawn rather than fork, since this process already runs threads
+            self.context = multiprocessing.get_context("spawn")
+            self.queue = self.context.Queue()
+            self.conf_dict = conf_to_dict(conf)
+
+    def check_accounts(self, shards):
+        """Refuse more shards than there are accounts to connect with"""
+        if len(shards) > len(self.accounts):
+            raise ValueError("%d stream connections need as many Twitter "
+                             "accounts, but only %d are configured (add "
+                             "[twitter.2], [twitter.3], ... sections)" %
+                             (len(shards), len(self.accounts)))
+
+    def open(self, shards, accounts):
+        """Open one connection per shard, each on the next of accounts"""
+        if self.processes:
+            return [ProcessConnection(self.context, self.conf_dict, self.queue,
+                                      account, track, follow, self.languages)
+                    for account, (track, follow) in zip(accounts, shards)]
+        connections = [create_supervisor(self.conf,
+                                         create_twitter_auth(self.conf,
+                                                             account),
+                                         self.listener,
+                                         track,
+                                         follow,
+                                         self.languages)
+                       for account, (track, follow) in zip(accounts, shards)]
+        for connection in connections:
+            connection.start()
+        return connections
+
+    def swap(self, shards):
+        """
+        Open connections for new shards on spare accounts, alongside the
+        current ones, and close the current ones once all the new ones are
+        live. If they don't all go live within swap_timeout seconds, keep the
+        current ones instead. Tweets seen on both are dropped by the listener.
+        Without enough spare accounts, the current connections are closed
+        before the new ones are opened, missing tweets in between.
+        """
+        try:
+            self.check_accounts(shards)
+        except ValueError as error:
+            print("Keeping the current stream connections: %s" % str(error))
+            return False
+        with self.lock:
+            spare = [account for account in self.accounts
+                     if account not in self.in_use]
+            if len(shards) > len(spare):
+                print("Not enough spare Twitter accounts to open the new "
+                      "stream connections first; closing the current ones")
+                for connection in self.connections:
+                    connection.close()
+                self.connections = self.open(shards, self.accounts)
+                self.in_use = self.accounts[:len(shards)]
+                print("Streaming across %d connections" % len(shards))
+                return True
+            connections = self.open(shards, spare)
+            deadline = time.time() + self.swap_timeout
+            for connection in connections:
+                if not connection.live.wait(max(0.0, deadline - time.time())):
+                    print("New stream connections did not go live; "
+                          "keeping the current ones")
+                    for new_connection in connections:
+                        new_connection.close()
+                    return False
+            for connection in self.connections:
+                connection.close()
+            self.connections = connections
+            self.in_use = spare[:len(shards)]
+            print("Streaming across %d connections" % len(connections))
+            return True
+
+    def run(self, shards):
+        """
+        Open connections for shards and block, passing on their data (parsed
+        and prefiltered by the stream processes, if reading in processes)
+        """
+        self.check_accounts(shards)
+        with self.lock:
+            self.connections = self.open(shards, self.accounts)
+            self.in_use = self.accounts[:len(shards)]
+            print("Streaming across %d connections" % len(shards))
+        if self.processes:
+            while True:
+                kind, item = self.queue.get()
+                try:
+                    if kind == "status":
+                        self.listener.on_record(item)
+                    elif kind == "delete":
+                        self.listener.on_delete(*item)
+                    else:
+                        self.listener.on_data(item)
+                except Exception as error:
+                    print("Error on_data: %s" % str(error))
+        else:
+            # connections are read (and swapped) by other threads
+            Event().wait()
@@ -0,0 +1,127 @@
+"""
+Supervision of a single Twitter stream connection: stalls are detected from
+the keep-alive newlines Twitter sends every 30 seconds, and the connection is
+re-established with jittered exponential backoff (reset once connected)
+from the supervisor's own thread, so that the reader thread never sleeps.
+"""
+
+import random
+from threading import Event, Thread
+
+import tweepy
+
+class SupervisedStream(tweepy.Stream):
+    """A Stream that leaves reconnecting to its supervisor"""
+    def on_closed(self, resp):
+        """Twitter closed the connection: stop, rather than retrying at once"""
+        self.running = False
+
+class StreamSupervisor:
+    """
+    Owns one stream connection for a listener, reconnecting it until closed.
+    It stands in for the listener on the stream, passing everything on but
+    taking over the handling of errors and timeouts.
+    """
+    def __init__(self, auth, listener, track=None, follow=None,
+                 languages=None, stall_timeout=90.0, max_backoff=320.0):
+        self.auth = auth
+        self.listener = listener
+        self.track = track
+        self.follow = follow
+        self.languages = languages
+        # no data or keep-alive for this many seconds means a stall
+        self.stall_timeout = stall_timeout
+        self.max_backoff = max_backoff
+
+        self.stream = None
+        self.running = False
+        self.stopped = Event()
+        # set once connected (and cleared on disconnection)
+        self.live = Event()
+        # consecutive failed connections, and the last HTTP error, if any
+        self.failures = 0
+        self.status_code = None
+
+    def start(self):
+        """Connect (and stay connected) from a new thread"""
+        self.running = True
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """Disconnect for good"""
+        self.running = False
+        self.stopped.set()
+        if self.stream is not None:
+            self.stream.disconnect()
+
+    def backoff(self):
+        """
+        Seconds to wait before the next attempt: doubling from 0.25 s after
+        network errors and stalls, from 5 s after HTTP errors, and from 60 s
+        when rate limited, up to max_backoff, with jitter so that several
+        connections don't retry in lockstep
+        """
+        if self.status_code in (420, 429):
+            base = 60.0
+        elif self.status_code is not None:
+            base = 5.0
+        else:
+            base = 0.25
+        delay = min(self.max_backoff, base * 2 ** self.failures)
+        self.failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def run(self):
+        """Reconnect loop, run in the supervisor's thread (see start)"""
+        while self.running:
+            self.status_code = None
+            self.stream = SupervisedStream(auth=self.auth,
+                                           listener=self,
+                                           timeout=self.stall_timeout,
+                                           daemon=True)
+            try:
+                self.stream.filter(track=self.track,
+                                   follow=self.follow,
+                                   languages=self.languages)
+            except Exception as error:
+                print("Stream connection lost: %s" % str(error))
+            self.live.clear()
+            if not self.running:
+                break
+            delay = self.backoff()
+            print("Reconnecting in %.1f seconds" % delay)
+            if self.stopped.wait(delay):
+                break
+
+    # the stream's listener methods
+
+    def on_connect(self):
+        self.failures = 0
+        self.live.set()
+        return self.listener.on_connect()
+
+    def keep_alive(self):
+        return self.listener.keep_alive()
+
+    def on_data(self, raw_data):
+        if not self.running:
+            return False
+        return self.listener.on_data(raw_data)
+
+    def on_error(self, status_code):
+        """Let the listener decide whether to give up, but never retry here"""
+        self.status_code = status_code
+        if self.listener.on_error(status_code) is False:
+            print("Stream closed after error %d" % status_code)
+            self.running = False
+        return False
+
+    def on_timeout(self):
+        """A read timed out: the connection stalled"""
+        print("Stream stalled (nothing for %.0f seconds)" % self.stall_timeout)
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.listener, name)
@@ -0,0 +1,228 @@
+"""
+Lightweight per-stage tracing and an on-demand sampling profiler, for finding
+out why a running monitor is falling behind without restarting it.
+
+Spans record how long each item spent in a stage into a per-stage ring
+buffer. The profiler periodically samples every thread's stack. Both are
+controlled by signals (SIGUSR1 toggles the profiler, SIGUSR2 dumps trace
+statistics) or by a local HTTP control endpoint.
+"""
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+class Tracer:
+    """Per-stage ring buffers of (start time, duration) for recent items"""
+    def __init__(self, size=10000):
+        self.size = size
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, start, duration):
+        """Record that an item spent duration seconds in stage"""
+        buffer = self.spans.get(stage)
+        if buffer is None:
+            with self.lock:
+                buffer = self.spans.setdefault(stage, deque(maxlen=self.size))
+        # deque.append is atomic, so no lock is needed here
+        buffer.append((start, duration))
+
+    @contextmanager
+    def span(self, stage):
+        """Time the enclosed block as one item passing through stage"""
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter() - began)
+
+    def trace(self, stage):
+        """Decorator timing every call of a function as a span of stage"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self, window=60.0):
+        """
+        Summarize each stage over the last window seconds: item count, rate,
+        mean, p50, p95 and max duration (in milliseconds).
+        """
+        cutoff = time.time() - window
+        summary = {}
+        for stage, buffer in list(self.spans.items()):
+            durations = sorted(duration for start, duration in list(buffer)
+                               if start >= cutoff)
+            if not durations:
+                continue
+            count = len(durations)
+            summary[stage] = {
+                "count": count,
+                "per_s": count / window,
+                "mean_ms": 1000 * sum(durations) / count,
+                "p50_ms": 1000 * durations[count // 2],
+                "p95_ms": 1000 * durations[min(count - 1, count * 95 // 100)],
+                "max_ms": 1000 * durations[-1]}
+        return summary
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every interval seconds while running,
+    counting how often each (collapsed) stack is seen.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.counts = Counter()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """Start sampling (if not already)"""
+        if self.running:
+            return
+        self.counts = Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample(self):
+        """Sampling loop, run in its own thread"""
+        own = threading.get_ident()
+        names = {}
+        while self.running:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = ";".join("%s:%s" % (entry.filename.rsplit("/", 1)[-1],
+                                            entry.name)
+                                 for entry in traceback.extract_stack(frame))
+                self.counts[names.get(ident, ident), stack] += 1
+            time.sleep(self.interval)
+
+    def dump(self, location):
+        """
+        Write samples in collapsed-stack format (one "thread;frame;... count"
+        line per stack), as read by flame graph tools.
+        """
+        with open(location, "w") as out_file:
+            for (thread, stack), count in self.counts.most_common():
+                out_file.write("%s;%s %d\n" % (thread, stack, count))
+        print("Profile written to " + location)
+
+# shared by everything in this process
+TRACER = Tracer()
+PROFILER = SamplingProfiler()
+HOOKS_INSTALLED = False
+
+def dump_location(kind, directory="."):
+    """A timestamped file name for a profile or trace dump"""
+    return os.path.join(directory, "%s_%s_%d.txt" %
+                        (kind, time.strftime("%Y-%m-%dT%H-%M-%S"), os.getpid()))
+
+def toggle_profiler(directory="."):
+    """Start the profiler, or stop it and dump its results"""
+    if PROFILER.running:
+        PROFILER.stop()
+        PROFILER.dump(dump_location("profile", directory))
+    else:
+        print("Profiler started")
+        PROFILER.start()
+
+def dump_trace(directory="."):
+    """Write per-stage statistics for the last minute to a file"""
+    location = dump_location("trace", directory)
+    with open(location, "w") as out_file:
+        json.dump(TRACER.stats(), out_file, indent=2)
+    print("Trace statistics written to " + location)
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    GET /trace for stage statistics, /profile/start, /profile/stop (which
+    returns the collapsed stacks) and /stacks for a snapshot of every thread
+    """
+    def log_message(self, *args):
+        pass
+
+    def reply(self, text, content_type="text/plain"):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/trace":
+            self.reply(json.dumps(TRACER.stats(), indent=2),
+                       "application/json")
+        elif self.path == "/profile/start":
+            PROFILER.start()
+            self.reply("profiler started\n")
+        elif self.path == "/profile/stop":
+            PROFILER.stop()
+            self.reply("".join("%s;%s %d\n" % (thread, stack, count)
+                               for (thread, stack), count
+                               in PROFILER.counts.most_common()))
+        elif self.path == "/stacks":
+            self.reply("\n".join("Thread %s\n%s" %
+                                 (ident, "".join(traceback.format_stack(frame)))
+                                 for ident, frame
+                                 in sys._current_frames().items()))
+        else:
+            self.send_error(404)
+
+def install_hooks(conf):
+    """
+    Install the profiling and tracing controls: SIGUSR1 toggles the
+    profiler and SIGUSR2 dumps trace statistics (both into
+    DEFAULT.profileLoc), and if DEFAULT.controlPort is set, an HTTP control
+    endpoint listens on that port on localhost. Only the first call in a
+    process has any effect.
+    """
+    global HOOKS_INSTALLED
+    if HOOKS_INSTALLED:
+        return
+    HOOKS_INSTALLED = True
+
+    directory = "."
+    if conf.has_option("DEFAULT", "profileLoc"):
+        directory = conf.get("DEFAULT", "profileLoc")
+
+    # signal handlers can only be set from the main thread
+    if (hasattr(signal, "SIGUSR1") and
+            threading.current_thread() is threading.main_thread()):
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: toggle_profiler(directory))
+        signal.signal(signal.SIGUSR2,
+                      lambda signum, frame: dump_trace(directory))
+
+    if conf.has_option("DEFAULT", "controlPort"):
+        server = ThreadingHTTPServer(("127.0.0.1",
+                                      conf.getint("DEFAULT", "controlPort")),
+                                     ControlHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Control endpoint on http://127.0.0.1:%d/" %
+              server.server_address[1])
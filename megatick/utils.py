@@ -2,7 +2,12 @@
 Support functions for megatick modules.
 """
 
+from collections import OrderedDict
+import os
+from queue import Empty
 import re
+import time
+from threading import Lock, Thread
 from urllib.parse import urljoin, urlparse
 
 import praw
@@ -10,6 +15,8 @@ import tweepy
 
 from py2neo import Graph
 
+from megatick.embedded import EmbeddedGraph
+
 def partition(pred, iterable):
     """
     Given a condition pred, produce two lists of the elements in iterable
@@ -25,13 +32,129 @@ def partition(pred, iterable):
             falses.append(item)
     return trues, falses
 
+class RecentSet:
+    """
+    Thread-safe set that remembers only the maxsize most recently added
+    items, forgetting the oldest first.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, item):
+        with self.lock:
+            return item in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def add(self, item):
+        """
+        Add item (or refresh it if present). Returns True if it was new.
+        """
+        with self.lock:
+            new = item not in self.items
+            self.items[item] = None
+            self.items.move_to_end(item)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+            return new
+
+def drain_queue(queue, max_items):
+    """
+    Block until an item is available on queue, then return it along with
+    any others already waiting, up to max_items in all. The caller must
+    call queue.task_done() once for each item returned.
+    """
+    items = [queue.get()]
+    while len(items) < max_items:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            break
+    return items
+
+def read_lines(location):
+    """Return the stripped lines of the file at location"""
+    with open(location, "r") as in_file:
+        return [line.strip() for line in in_file]
+
+def read_blacklists(conf, section):
+    """
+    Read the user blacklist (a list of IDs) and keyword blacklist (joined
+    with | for regex searches) named in a config section, either None if
+    not configured
+    """
+    user_blacklist = None
+    if conf.has_option(section, "userBlacklistLoc"):
+        user_blacklist = read_lines(conf.get(section, "userBlacklistLoc"))
+    kw_blacklist = None
+    if conf.has_option(section, "keywordBlacklistLoc"):
+        kw_blacklist = "|".join(read_lines(conf.get(section,
+                                                    "keywordBlacklistLoc")))
+    return user_blacklist, kw_blacklist
+
+class FileWatcher:
+    """
+    Calls callback() whenever any of the files at locations changes (checking
+    their modification times every interval seconds)
+    """
+    def __init__(self, locations, callback, interval=10.0):
+        self.locations = locations
+        self.callback = callback
+        self.interval = interval
+        self.mtimes = self.get_mtimes()
+        thread = Thread(target=self.watch, daemon=True)
+        thread.start()
+
+    def get_mtimes(self):
+        """The modification times of the files (None if missing)"""
+        mtimes = []
+        for location in self.locations:
+            try:
+                mtimes.append(os.stat(location).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def watch(self):
+        """Polling loop, run in its own thread"""
+        while True:
+            time.sleep(self.interval)
+            mtimes = self.get_mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                try:
+                    self.callback()
+                except Exception as error:
+                    print("Error reloading %s: %s" % (self.locations, error))
+
+def watch_files(conf, locations, callback):
+    """
+    Watch the files at locations (ignoring None), calling callback() when
+    they change, every DEFAULT.reloadInterval seconds (default 10, 0 to never
+    reload). Returns the FileWatcher, or None if not watching.
+    """
+    interval = 10.0
+    if conf.has_option("DEFAULT", "reloadInterval"):
+        interval = conf.getfloat("DEFAULT", "reloadInterval")
+    locations = [location for location in locations if location is not None]
+    if interval <= 0 or not locations:
+        return None
+    return FileWatcher(locations, callback, interval)
+
 def get_full_text(status):
     """Return the full text of a tweet, regardless of its length"""
     # Check if the tweet is extended (> 140 characters)
     try:
         full_text = status.extended_tweet['full_text']
     except AttributeError:
-        full_text = status.text
+        # compact records (and extended-mode statuses) carry full_text
+        full_text = getattr(status, 'full_text', None)
+        if full_text is None:
+            full_text = status.text
     return full_text
 
 def get_urls(status):
@@ -40,65 +163,16 @@ def get_urls(status):
     try:
         urls = [format(url['expanded_url']) for url in status.entities['urls']]
     except AttributeError:
-        urls = []
+        # compact records keep only the expanded urls
+        urls = list(getattr(status, 'urls', ()))
     return urls
 
-def tweet_is_notable(status,
-                     full_text=None,
-                     user_blacklist=None,
-                     kw_blacklist=None):
-    """Returns true if the status is to be recorded"""
-    # TODO: this should optionally allow an external (e.g., machine-learning)
-    #  model to make this decision.
-    if full_text is None:
-        full_text = get_full_text(status)
-
-    # we're not interested in RTs with no added info
-    non_rt = status.text[0:2] != 'RT'
-
-    # check if the user is to be excluded by rule
-    if user_blacklist is None:
-        # print("no user blacklist!")
-        user_ok = True
-    else:
-        user_ok = status.user.id_str not in user_blacklist
-    # if not user_ok:
-    #     print("blacklisted user " + status.user.name)
-
-    # check if the tweet contains text to be excluded
-    if kw_blacklist is None:
-        # print("no keyword blacklist!")
-        text_ok = True
-    else:
-        text_ok = re.search(kw_blacklist, full_text) is None
-    # if not text_ok:
-    #     print("blacklisted text " + full_text)
-    return non_rt and user_ok and text_ok
-
-def reddit_is_notable(submission,
-                      user_blacklist=None,
-                      kw_blacklist=None):
-    """Returns true if the submission is to be recorded"""
-    # TODO: this should optionally allow an external (e.g., machine-learning)
-    #  model to make this decision.
-    # check if the user is to be excluded by rule
-    if user_blacklist is None:
-        # print("no user blacklist!")
-        user_ok = True
-    else:
-        user_ok = submission.author.name not in user_blacklist
-    # if not user_ok:
-    #     print("blacklisted user " + submission.author.name)
-
-    # check if the submission contains text to be excluded
-    if kw_blacklist is None:
-        # print("no keyword blacklist!")
-        text_ok = True
-    else:
-        text_ok = re.search(kw_blacklist, submission.selftext) is None
-    # if not text_ok:
-    #     print("blacklisted text " + submission.selftext)
-    return user_ok and text_ok
+# URLs in free text (e.g. Markdown), which ends at whitespace or brackets
+URL_PATTERN = re.compile(r"https?://[^\s<>()\[\]\"']+")
+
+def find_urls(text):
+    """Return the URLs in text, without trailing punctuation"""
+    return [url.rstrip(".,;:!?*_") for url in URL_PATTERN.findall(text or "")]
 
 def url_is_valid(url):
     """
@@ -127,16 +201,26 @@ def url_is_valid(url):
                not url.startswith('http'))
     return not invalid
 
-def create_twitter_auth(conf):
+def create_twitter_auth(conf, section='twitter'):
     """Create Twitter API authorization from credentials"""
     # create OAuth authorization
-    auth = tweepy.OAuthHandler(conf.get('twitter', 'consumerKey'),
-                               conf.get('twitter', 'consumerSecret'))
+    auth = tweepy.OAuthHandler(conf.get(section, 'consumerKey'),
+                               conf.get(section, 'consumerSecret'))
     # grant auth access
-    auth.set_access_token(conf.get('twitter', 'authToken'),
-                          conf.get('twitter', 'authSecret'))
+    auth.set_access_token(conf.get(section, 'authToken'),
+                          conf.get(section, 'authSecret'))
     return auth
 
+def twitter_accounts(conf):
+    """
+    The config sections holding Twitter credentials: twitter, then
+    twitter.2, twitter.3 and so on, as far as they go
+    """
+    sections = ['twitter']
+    while conf.has_section('twitter.%d' % (len(sections) + 1)):
+        sections.append('twitter.%d' % (len(sections) + 1))
+    return sections
+
 def create_reddit_auth(conf):
     """Create Reddit API authorization from credentials"""
     reddit = praw.Reddit(client_id=conf.get('reddit', 'clientId'),
@@ -147,7 +231,18 @@ def create_reddit_auth(conf):
     return reddit
 
 def create_graph(conf):
-    """Retrieve Neo4j graph credentials and create Graph object"""
+    """
+    Retrieve Neo4j graph credentials and create Graph object, or open the
+    embedded graph file if neo4j.backend is "embedded"
+    """
+    if (conf.has_option('neo4j', 'backend') and
+            conf.get('neo4j', 'backend') == 'embedded'):
+        location = 'megatick.sqlite'
+        if conf.has_option('neo4j', 'embeddedLoc'):
+            location = conf.get('neo4j', 'embeddedLoc')
+        print("Loaded embedded graph at " + location)
+        return EmbeddedGraph(location)
+
     graph = Graph(user=conf.get('neo4j', 'user'),
                   password=conf.get('neo4j', 'pass'))
     if graph is not None:
@@ -0,0 +1,118 @@
+"""
+Pool of graph writer threads shared by the monitors and the scraper. Writes
+are routed by key (e.g. a user ID or URL) so that merges on the same key run
+one after another on the same writer, while writes on different keys run in
+parallel. Transient errors (deadlocks, lost connections, a locked database)
+are retried with backoff, and no error ever stops a writer.
+"""
+
+from concurrent.futures import Future
+import random
+import sqlite3
+import time
+from queue import Queue
+from threading import Lock, Thread
+import zlib
+
+from py2neo.errors import (ConnectionBroken, ConnectionLimit,
+                           ConnectionUnavailable, ServiceUnavailable,
+                           TransientError)
+
+def is_transient(error):
+    """True if an operation that raised error may succeed if retried"""
+    if isinstance(error, (TransientError, ConnectionBroken, ConnectionLimit,
+                          ConnectionUnavailable, ServiceUnavailable,
+                          ConnectionError, TimeoutError)):
+        return True
+    # e.g. Neo.TransientError.Transaction.DeadlockDetected
+    code = getattr(error, "code", None)
+    if isinstance(code, str) and ".TransientError." in code:
+        return True
+    return (isinstance(error, sqlite3.OperationalError) and
+            "locked" in str(error))
+
+class GraphWriter:
+    """
+    num_writers threads, each running the writes routed to it in order.
+    Transient errors are retried up to max_retries times, waiting a
+    jittered, doubling delay from base_delay seconds.
+    """
+    def __init__(self, num_writers=4, max_retries=5, base_delay=0.1,
+                 queue_size=1000):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        # bounded, so that a backlog of writes holds up whoever submits them
+        self.queues = [Queue(maxsize=queue_size) for _ in range(num_writers)]
+        for queue in self.queues:
+            thread = Thread(target=self.write, args=(queue,), daemon=True)
+            thread.start()
+
+    def route(self, key):
+        """The queue of the writer responsible for key"""
+        # a stable hash, so routing doesn't depend on hash randomization
+        index = zlib.crc32(str(key).encode("utf-8")) % len(self.queues)
+        return self.queues[index]
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) on the writer for key, returning a
+        Future of its result
+        """
+        future = Future()
+        self.route(key).put((future, function, args, kwargs))
+        return future
+
+    def call(self, key, function, *args, **kwargs):
+        """Run function on the writer for key and wait for its result"""
+        return self.submit(key, function, *args, **kwargs).result()
+
+    def join(self):
+        """Wait until every write submitted so far has been run"""
+        for queue in self.queues:
+            queue.join()
+
+    def write(self, queue):
+        """Writer loop, run in its own thread"""
+        while True:
+            future, function, args, kwargs = queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.attempt(function, args, kwargs))
+                except Exception as error:
+                    print("Error writing to graph: %s" % str(error))
+                    future.set_exception(error)
+            queue.task_done()
+
+    def attempt(self, function, args, kwargs):
+        """Run function, retrying it after transient errors"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                if attempt == self.max_retries or not is_transient(error):
+                    raise
+                delay = self.base_delay * 2 ** attempt
+                print("Retrying graph write in %.2f s after: %s" %
+                      (delay, str(error)))
+                time.sleep(random.uniform(delay / 2, delay))
+
+# one writer pool per graph, shared by everything in this process
+WRITERS = {}
+WRITERS_LOCK = Lock()
+
+def create_graph_writer(conf, graph):
+    """
+    Return the GraphWriter for graph, with DEFAULT.numGraphWriters writers
+    (default 4) retrying transient errors up to DEFAULT.graphRetries times
+    (default 5)
+    """
+    with WRITERS_LOCK:
+        if id(graph) not in WRITERS:
+            num_writers = 4
+            if conf.has_option("DEFAULT", "numGraphWriters"):
+                num_writers = conf.getint("DEFAULT", "numGraphWriters")
+            max_retries = 5
+            if conf.has_option("DEFAULT", "graphRetries"):
+                max_retries = conf.getint("DEFAULT", "graphRetries")
+            WRITERS[id(graph)] = GraphWriter(num_writers, max_retries)
+        return WRITERS[id(graph)]
@@ -0,0 +1,11 @@
+#!/usr/bin/python3
+
+from megatick.runner import MonitorRunner
+
+def main():
+    """Monitor Twitter, Reddit and RSS feeds from a single process."""
+    runner = MonitorRunner()
+    runner.start()
+
+if __name__ == "__main__":
+    main()
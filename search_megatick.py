@@ -0,0 +1,19 @@
+#!/usr/bin/python3
+
+import configparser
+import sys
+
+from megatick.search import create_search_index
+
+def main():
+    """Search stored tweets, submissions and pages for the given keywords."""
+    conf = configparser.ConfigParser()
+    conf.read("config.ini")
+    search_index = create_search_index(conf)
+    if search_index is None:
+        sys.exit("No search index configured at DEFAULT.searchIndexLoc")
+    for label, key, score in search_index.query(" ".join(sys.argv[1:])):
+        print("%.3f\t%s\t%s" % (score, label, key))
+
+if __name__ == "__main__":
+    main()
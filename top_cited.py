@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+import configparser
+import sys
+
+from megatick.database import ensure_indexes, top_nodes
+from megatick.utils import create_graph
+
+def main():
+    """Print the most cited pages and the most prolific authors."""
+    conf = configparser.ConfigParser()
+    conf.read("config.ini")
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    graph = create_graph(conf)
+    ensure_indexes(graph)
+    for label, counter, key in [("WebPage", "cited_count", "url"),
+                                ("Tweet", "cited_count", "tweet_id"),
+                                ("TwitterUser", "authored_count", "handle"),
+                                ("Redditor", "authored_count", "name")]:
+        print("%s by %s" % (label, counter))
+        for node in top_nodes(graph, label, counter, limit):
+            print("%d\t%s" % (node[counter], node[key]))
+
+if __name__ == "__main__":
+    main()